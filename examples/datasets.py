@@ -2,27 +2,86 @@
 
 """Datasets used in examples."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-from jax import random
+from concurrent import futures
+import os
+from jax.api import device_put
 import numpy as np
 import tensorflow_datasets as tfds
 
 
-def _partial_flatten_and_normalize(x):
-  """Flatten all but the first dimension of an `np.ndarray`."""
-  x = np.reshape(x, (x.shape[0], -1))
-  return (x - np.mean(x)) / np.std(x)
+_SPLITS = ('train_images', 'train_labels', 'test_images', 'test_labels')
+
+# Version of the processing written to the cache. Bump it whenever the
+# processing changes, so that stale caches are not loaded.
+_CACHE_VERSION = 2
+
+# Normalization statistics are estimated on every this many-th example.
+_STATS_STRIDE = 10
+
+
+def _partial_flatten_and_normalize(x, stats_stride=_STATS_STRIDE,
+                                   normalize=True, out=None):
+  """Flatten all but the first dimension of an `np.ndarray`.
+
+  The mean and standard deviation used for normalization are estimated on
+  every `stats_stride`-th example only. If `normalize` is `False`, the
+  flattened data is only cast to `np.float32`. The result is written to `out`
+  if provided, otherwise to a newly allocated `np.float32` array.
+  """
+  # Flatten as a view of the input and write the result into a single float32
+  # buffer, so that at most one new `[n, d]` array is allocated.
+  x = x.reshape((x.shape[0], -1))
+  if out is None:
+    out = np.empty(x.shape, np.float32)
+  if not normalize:
+    out[...] = x
+    return out
+
+  sample = x[::stats_stride]
+  np.subtract(x, sample.mean(dtype=np.float32), out=out, dtype=np.float32)
+  out *= 1. / sample.std(dtype=np.float32)
+  return out
 
 
 def _one_hot(x, k, dtype=np.float32):
   """Create a one-hot encoding of x of size k."""
-  return np.array(x[:, None] == np.arange(k), dtype)
+  return np.eye(k, dtype=dtype)[np.asarray(x, np.intp)]
+
+
+def _cache_name(name, normalize):
+  """Cache file prefix, encoding the cache version and processing parameters."""
+  processing = ('float32_stride{}'.format(_STATS_STRIDE) if normalize
+                else 'float32_unnormalized')
+  return '{}_v{}_{}'.format(name, _CACHE_VERSION, processing)
+
+
+def _cache_paths(name, cache_dir):
+  return [os.path.join(cache_dir, '{}_{}.npy'.format(name, split))
+          for split in _SPLITS]
 
 
-def get_dataset(name, n_train=None, n_test=None, permute_train=False):
-  """Download, parse and process MNIST data to unit scale and one-hot labels."""
+def _load_from_cache(name, cache_dir):
+  """Memory-map processed arrays of `name`, or return `None` if not cached."""
+  paths = _cache_paths(name, cache_dir)
+  if not all(os.path.exists(path) for path in paths):
+    return None
+  return tuple(np.load(path, mmap_mode='r') for path in paths)
+
+
+def _save_to_cache(name, cache_dir, arrays):
+  """Save processed arrays of `name` so that later runs can memory-map them."""
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  for path, array in zip(_cache_paths(name, cache_dir), arrays):
+    # Write to a temporary file first so that an interrupted run never leaves a
+    # truncated array behind.
+    with open(path + '.tmp', 'wb') as f:
+      np.save(f, array)
+    os.rename(path + '.tmp', path)
+
+
+def _load_and_process(name, normalize):
+  """Download `name` via TFDS, flatten and normalize images, one-hot labels."""
   ds_train, ds_test = tfds.as_numpy(
       tfds.load(
           name,
@@ -34,10 +93,39 @@ def get_dataset(name, n_train=None, n_test=None, permute_train=False):
                                                           ds_test["image"],
                                                           ds_test["label"])
 
-  train_images = _partial_flatten_and_normalize(train_images)
-  test_images = _partial_flatten_and_normalize(test_images)
-  train_labels = _one_hot(train_labels, 10)
-  test_labels = _one_hot(test_labels, 10)
+  # Process both splits into one images and one labels buffer and return row
+  # slices of them, which are contiguous views.
+  n_train = train_images.shape[0]
+  images = np.empty(
+      (n_train + test_images.shape[0], np.prod(train_images.shape[1:])),
+      np.float32)
+  _partial_flatten_and_normalize(train_images, normalize=normalize,
+                                 out=images[:n_train])
+  _partial_flatten_and_normalize(test_images, normalize=normalize,
+                                 out=images[n_train:])
+  labels = _one_hot(np.concatenate([train_labels, test_labels]), 10)
+  return images[:n_train], labels[:n_train], images[n_train:], labels[n_train:]
+
+
+def get_dataset(name, n_train=None, n_test=None, permute_train=False,
+                cache_dir=None, normalize=True):
+  """Download, parse and process a dataset to unit scale and one-hot labels.
+
+  If `cache_dir` is given, processed arrays are stored there and memory-mapped
+  on subsequent calls, so that only the requested `n_train` / `n_test` rows are
+  read from disk. By default, nothing is written and the dataset is downloaded
+  and processed from scratch.
+  Pass `normalize=False` to skip rescaling images to zero mean and unit
+  variance.
+  """
+  cache_name = _cache_name(name, normalize)
+  arrays = (None if cache_dir is None else
+            _load_from_cache(cache_name, cache_dir))
+  if arrays is None:
+    arrays = _load_and_process(name, normalize)
+    if cache_dir is not None:
+      _save_to_cache(cache_name, cache_dir, arrays)
+  train_images, train_labels, test_images, test_labels = arrays
 
   if n_train is not None:
     train_images = train_images[:n_train]
@@ -54,24 +142,52 @@ def get_dataset(name, n_train=None, n_test=None, permute_train=False):
   return train_images, train_labels, test_images, test_labels
 
 
-def minibatch(x_train, y_train, batch_size, train_epochs):
-  """Generate minibatches of data for a set number of epochs."""
+def _minibatches(x_train, y_train, batch_size, train_epochs):
+  """Slice minibatches on the host, reshuffling the data after every epoch."""
   epoch = 0
   start = 0
-  key = random.PRNGKey(0)
+  rng = np.random.RandomState(0)
+  # Gather from contiguous float32 arrays so that batches are float32 as well
+  # and no wider than what is sent to the device.
+  x_train = np.ascontiguousarray(x_train, np.float32)
+  y_train = np.ascontiguousarray(y_train, np.float32)
+  # Shuffle indices rather than the data itself, so that each epoch only
+  # gathers `batch_size` rows at a time instead of copying the whole dataset.
+  indices = np.arange(x_train.shape[0], dtype=np.int32)
 
   while epoch < train_epochs:
     end = start + batch_size
 
     if end > x_train.shape[0]:
-      key, split = random.split(key)
-      permutation = random.shuffle(split,
-                                   np.arange(x_train.shape[0], dtype=np.int64))
-      x_train = x_train[permutation]
-      y_train = y_train[permutation]
+      rng.shuffle(indices)
       epoch = epoch + 1
       start = 0
       continue
 
-    yield x_train[start:end], y_train[start:end]
+    batch_indices = indices[start:end]
+    yield x_train[batch_indices], y_train[batch_indices]
     start = start + batch_size
+
+
+def _next_on_device(batches):
+  """Copy the next batch to the device, or return `None` if exhausted."""
+  batch = next(batches, None)
+  return None if batch is None else device_put(batch)
+
+
+def minibatch(x_train, y_train, batch_size, train_epochs):
+  """Generate minibatches of data for a set number of epochs.
+
+  The next minibatch is prepared and copied to the device on a background
+  thread while the caller is consuming the current one.
+  """
+  batches = _minibatches(x_train, y_train, batch_size, train_epochs)
+
+  with futures.ThreadPoolExecutor(max_workers=1) as executor:
+    next_batch = executor.submit(_next_on_device, batches)
+    while True:
+      batch = next_batch.result()
+      if batch is None:
+        return
+      next_batch = executor.submit(_next_on_device, batches)
+      yield batch
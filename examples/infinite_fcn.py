@@ -5,6 +5,7 @@
 By default, this example does inference on a small CIFAR10 subset.
 """
 
+import math
 import time
 from absl import app
 from absl import flags
@@ -19,18 +20,36 @@ flags.DEFINE_integer('train_size', 1000,
                      'Dataset size to use for training.')
 flags.DEFINE_integer('test_size', 1000,
                      'Dataset size to use for testing.')
-flags.DEFINE_integer('batch_size', 0,
-                     'Batch size for kernel computation. 0 for no batching.')
+flags.DEFINE_integer('batch_size', -1,
+                     'Batch size for kernel computation. 0 for no batching, '
+                     '-1 to pick the largest one fitting `kernel_memory_mb`.')
+flags.DEFINE_integer('kernel_memory_mb', 1024,
+                     'Memory budget for one batch of the kernel, used when '
+                     '`batch_size` is -1.')
+flags.DEFINE_boolean('normalize', True,
+                     'Whether to rescale inputs to zero mean and unit variance.')
 
 
 FLAGS = flags.FLAGS
 
 
+def _auto_batch_size(n_train, n_test, memory_bytes, n_kernels=2):
+  """Largest batch size, up to the smaller dataset, fitting `memory_bytes`.
+
+  Each batch holds `n_kernels` float32 kernels of shape
+  `[batch_size, batch_size]`. The batch size need not divide the dataset
+  sizes: `nt.batch` pads ragged inputs to a whole number of batches.
+  """
+  batch_size = int(math.sqrt(memory_bytes / (n_kernels * 4)))
+  return max(1, min(batch_size, n_train, n_test))
+
+
 def main(unused_argv):
   # Build data pipelines.
   print('Loading data.')
   x_train, y_train, x_test, y_test = \
-    datasets.get_dataset('cifar10', FLAGS.train_size, FLAGS.test_size)
+    datasets.get_dataset('cifar10', FLAGS.train_size, FLAGS.test_size,
+                         normalize=FLAGS.normalize)
 
   # Build the infinite network.
   _, _, kernel_fn = stax.serial(
@@ -40,9 +59,14 @@ def main(unused_argv):
   )
 
   # Optionally, compute the kernel in batches, in parallel.
+  batch_size = FLAGS.batch_size
+  if batch_size == -1:
+    batch_size = _auto_batch_size(FLAGS.train_size, FLAGS.test_size,
+                                  FLAGS.kernel_memory_mb * 2**20)
+    print('Using batch size {}.'.format(batch_size))
   kernel_fn = nt.batch(kernel_fn,
                        device_count=0,
-                       batch_size=FLAGS.batch_size)
+                       batch_size=batch_size)
 
   start = time.time()
   # Bayesian and infinite-time gradient descent inference with infinite network.
@@ -9,9 +9,6 @@ minibatching on the full MNIST dataset. Data is loaded using tensorflow
 datasets.
 """
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from absl import app
 from absl import flags
 from jax import random
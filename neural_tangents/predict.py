@@ -1,10 +1,6 @@
 # Copyright 2019 The Neural Tangents Authors.  All rights reserved.
 """Functions to make predictions on the test set using NTK kernel."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-
 import collections
 import functools
 
@@ -49,9 +49,6 @@ Example:
   ```
 """
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from functools import wraps
 import warnings
 import enum
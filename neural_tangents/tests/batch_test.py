@@ -1,9 +1,7 @@
 # Copyright 2019 The Neural Tangents Authors.  All rights reserved.
 """Tests for the Neural Tangents library."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
+from functools import lru_cache
 from functools import partial
 from jax import test_util as jtu
 from jax.api import jit
@@ -11,6 +9,8 @@ from jax.config import config as jax_config
 import jax.numpy as np
 import jax.random as random
 from jax.tree_util import tree_map
+from jax.tree_util import tree_multimap
+from jax.tree_util import tree_structure
 from neural_tangents import stax
 from neural_tangents.utils import batch
 from neural_tangents.utils import empirical
@@ -32,6 +32,7 @@ OUTPUT_LOGITS = [1, 2, 3]
 CONVOLUTION_CHANNELS = 256
 
 
+@lru_cache(maxsize=None)
 def _build_network(input_shape, network, out_logits):
   if len(input_shape) == 1:
     assert network == 'FLAT'
@@ -53,15 +54,25 @@ def _build_network(input_shape, network, out_logits):
     raise ValueError('Expected flat or image test input.')
 
 
+# NOTE: every batching configuration is compared against the same unbatched
+# kernel, so the jitted NTK function is memoized per network and the
+# parameters are bound with `partial` afterwards.
+@lru_cache(maxsize=None)
+def _jit_empirical_ntk_fn(input_shape, network, out_logits):
+  _, f, _ = _build_network(input_shape, network, out_logits)
+  return jit(empirical.empirical_ntk_fn(f))
+
+
 def _empirical_kernel(key, input_shape, network, out_logits):
-  init_fn, f, _ = _build_network(input_shape, network, out_logits)
+  init_fn, _, _ = _build_network(input_shape, network, out_logits)
   _, params = init_fn(key, (-1,) + input_shape)
-  kernel_fn = jit(empirical.empirical_ntk_fn(f))
+  kernel_fn = _jit_empirical_ntk_fn(input_shape, network, out_logits)
 
   return partial(kernel_fn, params=params)
 
 
-def _theoretical_kernel(unused_key, input_shape, network, just_theta):
+@lru_cache(maxsize=None)
+def _jit_theoretical_kernel_fn(input_shape, network, just_theta):
   _, _, _kernel_fn = _build_network(input_shape, network, 1)
 
   @jit
@@ -73,6 +84,10 @@ def _theoretical_kernel(unused_key, input_shape, network, just_theta):
   return kernel_fn
 
 
+def _theoretical_kernel(unused_key, input_shape, network, just_theta):
+  return _jit_theoretical_kernel_fn(input_shape, network, just_theta)
+
+
 KERNELS = {}
 for o in OUTPUT_LOGITS:
   KERNELS['empirical_logits_{}'.format(o)] = partial(
@@ -81,19 +96,48 @@ KERNELS['theoretical'] = partial(_theoretical_kernel, just_theta=True)
 KERNELS['theoretical_pytree'] = partial(_theoretical_kernel, just_theta=False)
 
 
-def _test_kernel_against_batched(cls, kernel_fn, batched_kernel_fn, train,
+@lru_cache(maxsize=None)
+def _get_inputs(train_shape, test_shape):
+  key = random.PRNGKey(0)
+  key, self_split, other_split = random.split(key, 3)
+  data_self = random.normal(self_split, train_shape)
+  data_other = random.normal(other_split, test_shape)
+  return key, data_self, data_other
+
+
+def _assert_kernels_close(cls, g, g_b):
+  cls.assertEqual(tree_structure(g), tree_structure(g_b))
+  tree_multimap(partial(cls.assertAllClose, check_dtypes=True), g, g_b)
+
+
+def _test_kernel_against_batched(cls, kernel_fn, batched_kernel_fns, train,
                                  test):
-  g = kernel_fn(train, None)
-  g_b = batched_kernel_fn(train, None)
-  cls.assertAllClose(g, g_b, check_dtypes=True)
+  # Compute the reference kernels once and compare every batched variant
+  # against them.
+  g_self = kernel_fn(train, None)
+  g_other = kernel_fn(train, test)
 
-  g = kernel_fn(train, test)
-  g_b = batched_kernel_fn(train, test)
-  cls.assertAllClose(g, g_b, check_dtypes=True)
+  for batched_kernel_fn in batched_kernel_fns:
+    g_b = batched_kernel_fn(train, None)
+    _assert_kernels_close(cls, g_self, g_b)
+
+    g_b = batched_kernel_fn(train, test)
+    _assert_kernels_close(cls, g_other, g_b)
 
 
 class BatchTest(jtu.JaxTestCase):
 
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    # Build every kernel function once, to be shared by all test methods.
+    cls._kernels = {}
+    for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK):
+      key, _, _ = _get_inputs(train, test)
+      for name, kernel_fn in KERNELS.items():
+        cls._kernels[(train, network, name)] = kernel_fn(key, train[1:],
+                                                         network)
+
   # pylint: disable=g-complex-comprehension
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list(
@@ -109,22 +153,20 @@ class BatchTest(jtu.JaxTestCase):
                 network,
               'name':
                 name,
-              'kernel_fn':
-                kernel_fn
           }
           for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
-          for name, kernel_fn in KERNELS.items()))
-  def testSerial(self, train_shape, test_shape, network, name, kernel_fn):
-    key = random.PRNGKey(0)
-    key, self_split, other_split = random.split(key, 3)
-    data_self = random.normal(self_split, train_shape)
-    data_other = random.normal(other_split, test_shape)
-
-    kernel_fn = kernel_fn(key, train_shape[1:], network)
+          for name in KERNELS))
+  def testSerial(self, train_shape, test_shape, network, name):
+    _, data_self, data_other = _get_inputs(train_shape, test_shape)
+    kernel_fn = self._kernels[(train_shape, network, name)]
+    # Test both computing batches one at a time and all at once.
     kernel_batched = batch._serial(kernel_fn, batch_size=2)
+    kernel_batched_vmap = batch._serial(kernel_fn, batch_size=2,
+                                        vmap_blocks=True)
 
-    _test_kernel_against_batched(self, kernel_fn, kernel_batched, data_self,
-                                 data_other)
+    _test_kernel_against_batched(
+        self, kernel_fn, [kernel_batched, kernel_batched_vmap], data_self,
+        data_other)
 
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list(
@@ -140,23 +182,18 @@ class BatchTest(jtu.JaxTestCase):
                 network,
               'name':
                 name,
-              'kernel_fn':
-                kernel_fn
           }
           for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
-          for name, kernel_fn in KERNELS.items()))
-  def testParallel(self, train_shape, test_shape, network, name, kernel_fn):
-    utils.stub_out_pmap(batch, 2)
-
-    key = random.PRNGKey(0)
-    key, self_split, other_split = random.split(key, 3)
-    data_self = random.normal(self_split, train_shape)
-    data_other = random.normal(other_split, test_shape)
-
-    kernel_fn = kernel_fn(key, train_shape[1:], network)
-    kernel_batched = batch._parallel(kernel_fn)
-
-    _test_kernel_against_batched(self, kernel_fn, kernel_batched, data_self,
+          for name in KERNELS))
+  def testSerialRagged(self, train_shape, test_shape, network, name):
+    _, data_self, data_other = _get_inputs(train_shape, test_shape)
+    kernel_fn = self._kernels[(train_shape, network, name)]
+    kernels_batched = [
+        batch._serial(kernel_fn, batch_size=3, store_on_device=store_on_device)
+        for store_on_device in [True, False]
+    ]
+
+    _test_kernel_against_batched(self, kernel_fn, kernels_batched, data_self,
                                  data_other)
 
   @jtu.parameterized.named_parameters(
@@ -173,27 +210,21 @@ class BatchTest(jtu.JaxTestCase):
                 network,
               'name':
                 name,
-              'kernel_fn':
-                kernel_fn
           }
           for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
-          for name, kernel_fn in KERNELS.items()))
-  def testComposition(self, train_shape, test_shape, network, name, kernel_fn):
-    utils.stub_out_pmap(batch, 2)
-
-    key = random.PRNGKey(0)
-    key, self_split, other_split = random.split(key, 3)
-    data_self = random.normal(self_split, train_shape)
-    data_other = random.normal(other_split, test_shape)
-
-    kernel_fn = kernel_fn(key, train_shape[1:], network)
-
-    kernel_batched = batch._parallel(batch._serial(kernel_fn, batch_size=2))
-    _test_kernel_against_batched(self, kernel_fn, kernel_batched, data_self,
-                                 data_other)
-
-    kernel_batched = batch._serial(batch._parallel(kernel_fn), batch_size=2)
-    _test_kernel_against_batched(self, kernel_fn, kernel_batched, data_self,
+          for name in KERNELS))
+  def testParallelRagged(self, train_shape, test_shape, network, name):
+    utils.skip_unless_device_count(self, 2)
+
+    _, data_self, data_other = _get_inputs(train_shape, test_shape)
+    kernel_fn = self._kernels[(train_shape, network, name)]
+    kernels_batched = [
+        batch._serial(batch._parallel(kernel_fn, 2), batch_size=3,
+                      store_on_device=store_on_device)
+        for store_on_device in [True, False]
+    ]
+
+    _test_kernel_against_batched(self, kernel_fn, kernels_batched, data_self,
                                  data_other)
 
   @jtu.parameterized.named_parameters(
@@ -210,27 +241,77 @@ class BatchTest(jtu.JaxTestCase):
                 network,
               'name':
                 name,
-              'kernel_fn':
-                kernel_fn
           }
           for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
-          for name, kernel_fn in KERNELS.items()))
-  def testAutomatic(self, train_shape, test_shape, network, name, kernel_fn):
-    utils.stub_out_pmap(batch, 2)
+          for name in KERNELS))
+  def testParallel(self, train_shape, test_shape, network, name):
+    utils.skip_unless_device_count(self, 2)
 
-    key = random.PRNGKey(0)
-    key, self_split, other_split = random.split(key, 3)
-    data_self = random.normal(self_split, train_shape)
-    data_other = random.normal(other_split, test_shape)
+    _, data_self, data_other = _get_inputs(train_shape, test_shape)
+    kernel_fn = self._kernels[(train_shape, network, name)]
+    kernel_batched = batch._parallel(kernel_fn)
 
-    kernel_fn = kernel_fn(key, train_shape[1:], network)
+    _test_kernel_against_batched(self, kernel_fn, [kernel_batched], data_self,
+                                 data_other)
 
-    kernel_batched = batch.batch(kernel_fn, batch_size=2)
-    _test_kernel_against_batched(self, kernel_fn, kernel_batched, data_self,
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list(
+          {
+              'testcase_name':
+                '_train_shape={}_test_shape={}_network={}_{}'.format(
+                    train, test, network, name),
+              'train_shape':
+                train,
+              'test_shape':
+                test,
+              'network':
+                network,
+              'name':
+                name,
+          }
+          for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
+          for name in KERNELS))
+  def testComposition(self, train_shape, test_shape, network, name):
+    utils.skip_unless_device_count(self, 2)
+
+    _, data_self, data_other = _get_inputs(train_shape, test_shape)
+    kernel_fn = self._kernels[(train_shape, network, name)]
+
+    kernels_batched = [
+        batch._parallel(batch._serial(kernel_fn, batch_size=2)),
+        batch._serial(batch._parallel(kernel_fn), batch_size=2)
+    ]
+    _test_kernel_against_batched(self, kernel_fn, kernels_batched, data_self,
                                  data_other)
 
-    kernel_batched = batch.batch(kernel_fn, batch_size=2, store_on_device=False)
-    _test_kernel_against_batched(self, kernel_fn, kernel_batched, data_self,
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list(
+          {
+              'testcase_name':
+                '_train_shape={}_test_shape={}_network={}_{}'.format(
+                    train, test, network, name),
+              'train_shape':
+                train,
+              'test_shape':
+                test,
+              'network':
+                network,
+              'name':
+                name,
+          }
+          for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
+          for name in KERNELS))
+  def testAutomatic(self, train_shape, test_shape, network, name):
+    utils.skip_unless_device_count(self, 2)
+
+    _, data_self, data_other = _get_inputs(train_shape, test_shape)
+    kernel_fn = self._kernels[(train_shape, network, name)]
+
+    kernels_batched = [
+        batch.batch(kernel_fn, batch_size=2),
+        batch.batch(kernel_fn, batch_size=2, store_on_device=False)
+    ]
+    _test_kernel_against_batched(self, kernel_fn, kernels_batched, data_self,
                                  data_other)
 
   def _test_analytic_kernel_composition(self, batching_fn):
@@ -267,7 +348,7 @@ class BatchTest(jtu.JaxTestCase):
         partial(batch._serial, batch_size=2, store_on_device=store_on_device))
 
   def testAnalyticKernelComposeParallel(self):
-    utils.stub_out_pmap(batch, 2)
+    utils.skip_unless_device_count(self, 2)
     self._test_analytic_kernel_composition(batch._parallel)
 
   @jtu.parameterized.named_parameters(
@@ -280,7 +361,7 @@ class BatchTest(jtu.JaxTestCase):
           }
           for store_on_device in [True, False]))
   def testAnalyticKernelComposeAutomatic(self, store_on_device):
-    utils.stub_out_pmap(batch, 2)
+    utils.skip_unless_device_count(self, 2)
     self._test_analytic_kernel_composition(
         partial(batch.batch, batch_size=2, store_on_device=store_on_device))
 
@@ -296,6 +377,10 @@ class BatchTest(jtu.JaxTestCase):
       res *= random.uniform(keys) * p
       return [res, params]
 
+    # Reference values are computed with a single fused computation per
+    # combination of the boolean flags.
+    kernel_fn_jit = jit(kernel_fn, static_argnums=(2, 4))
+
     params = (np.array([1., 0.3]), (np.array([1.2]), np.array([0.5])))
     x2 = np.arange(0, 10).reshape((10,))
     keys = random.PRNGKey(1)
@@ -305,19 +390,18 @@ class BatchTest(jtu.JaxTestCase):
     for do_flip in [True, False]:
       for do_square in [True, False]:
         with self.subTest(do_flip=do_flip, do_square=do_square, device_count=0):
-          res_1 = kernel_fn(
+          res_1 = kernel_fn_jit(
               x1, x2, do_flip, keys, do_square, params, _unused=True, p=0.65)
           res_2 = kernel_fn_pmapped(
               x1, x2, do_flip, keys, do_square, params, _unused=True)
           self.assertAllClose(res_1, res_2, True)
 
-    utils.stub_out_pmap(batch, 1)
     x1 = np.arange(0, 10).reshape((1, 10))
     kernel_fn_pmapped = batch._jit_or_pmap_broadcast(kernel_fn, device_count=1)
     for do_flip in [True, False]:
       for do_square in [True, False]:
         with self.subTest(do_flip=do_flip, do_square=do_square, device_count=1):
-          res_1 = kernel_fn(
+          res_1 = kernel_fn_jit(
               x1, x2, do_flip, keys, do_square, params, _unused=False, p=0.65)
           res_2 = kernel_fn_pmapped(
               x1, x2, do_flip, keys, do_square, params, _unused=None)
@@ -326,9 +410,9 @@ class BatchTest(jtu.JaxTestCase):
               tree_map(partial(np.expand_dims, axis=0), res_1[1]), res_2[1],
               True)
 
+    utils.skip_unless_device_count(self, 2)
     kernel_fn_pmapped = batch._jit_or_pmap_broadcast(kernel_fn, device_count=2)
     x1 = np.arange(0, 20).reshape((2, 10))
-    utils.stub_out_pmap(batch, 2)
 
     def broadcast(arg):
       return np.broadcast_to(arg, (2,) + arg.shape)
@@ -336,7 +420,7 @@ class BatchTest(jtu.JaxTestCase):
     for do_flip in [True, False]:
       for do_square in [True, False]:
         with self.subTest(do_flip=do_flip, do_square=do_square, device_count=2):
-          res_1 = kernel_fn(x1, x2, do_flip, keys, do_square, params, p=0.2)
+          res_1 = kernel_fn_jit(x1, x2, do_flip, keys, do_square, params, p=0.2)
           res_2 = kernel_fn_pmapped(
               x1, x2, do_flip, keys, do_square, params, _unused=None, p=0.2)
           self.assertAllClose(res_1[0][0], res_2[0][0], True)
@@ -345,4 +429,5 @@ class BatchTest(jtu.JaxTestCase):
 
 
 if __name__ == '__main__':
+  utils.set_host_device_count(2)
   jtu.absltest.main()
@@ -0,0 +1,11 @@
+# Copyright 2019 The Neural Tangents Authors.  All rights reserved.
+"""Configuration shared by all tests when run with `pytest`."""
+
+from neural_tangents.utils import utils
+
+
+def pytest_configure(config):
+  del config
+  # Runs before any test module is imported, hence before the JAX backend is
+  # initialized. Parallel tests are skipped if the devices are not available.
+  utils.set_host_device_count(2)
@@ -0,0 +1,74 @@
+# Copyright 2019 The Neural Tangents Authors.  All rights reserved.
+
+"""Tests for `examples/datasets.py`."""
+
+import tempfile
+from jax import test_util as jtu
+from jax.config import config
+import numpy as onp
+from examples import datasets
+
+
+config.parse_flags_with_absl()
+
+
+def _arrays(n_train=6, n_test=4, d=3):
+  rng = onp.random.RandomState(0)
+  return (rng.randn(n_train, d).astype(onp.float32),
+          onp.eye(10, dtype=onp.float32)[rng.randint(10, size=n_train)],
+          rng.randn(n_test, d).astype(onp.float32),
+          onp.eye(10, dtype=onp.float32)[rng.randint(10, size=n_test)])
+
+
+class DatasetsTest(jtu.JaxTestCase):
+
+  def test_cache_round_trip(self):
+    arrays = _arrays()
+    name = datasets._cache_name('mnist', True)
+    with tempfile.TemporaryDirectory() as cache_dir:
+      self.assertIsNone(datasets._load_from_cache(name, cache_dir))
+      datasets._save_to_cache(name, cache_dir, arrays)
+      for expected, actual in zip(arrays,
+                                  datasets._load_from_cache(name, cache_dir)):
+        self.assertAllClose(expected, onp.asarray(actual), True)
+
+  def test_cache_invalidation(self):
+    name = datasets._cache_name('mnist', True)
+    self.assertNotEqual(name, datasets._cache_name('mnist', False))
+    self.assertNotEqual(name, datasets._cache_name('cifar10', True))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      datasets._save_to_cache(name, cache_dir, _arrays())
+      self.assertIsNone(
+          datasets._load_from_cache(datasets._cache_name('mnist', False),
+                                    cache_dir))
+
+      version = datasets._CACHE_VERSION
+      datasets._CACHE_VERSION = version + 1
+      try:
+        bumped_name = datasets._cache_name('mnist', True)
+      finally:
+        datasets._CACHE_VERSION = version
+      self.assertNotEqual(name, bumped_name)
+      self.assertIsNone(datasets._load_from_cache(bumped_name, cache_dir))
+
+  def test_partial_flatten_and_normalize(self):
+    x = onp.random.RandomState(0).randint(0, 256, (40, 4, 4, 3), onp.uint8)
+
+    x_flat = datasets._partial_flatten_and_normalize(x, normalize=False)
+    self.assertEqual(onp.float32, x_flat.dtype)
+    self.assertAllClose(x.reshape((40, -1)).astype(onp.float32), x_flat, True)
+
+    out = onp.empty((40, 48), onp.float32)
+    x_norm = datasets._partial_flatten_and_normalize(x, stats_stride=4,
+                                                     out=out)
+    self.assertIs(out, x_norm)
+    self.assertEqual((40, 48), x_norm.shape)
+    # Statistics are estimated on every `stats_stride`-th example, so those
+    # examples are normalized exactly.
+    self.assertAllClose(0., x_norm[::4].mean(), False, atol=1e-4, rtol=1e-4)
+    self.assertAllClose(1., x_norm[::4].std(), False, atol=1e-4, rtol=1e-4)
+
+
+if __name__ == '__main__':
+  jtu.absltest.main()
@@ -2,9 +2,6 @@
 
 """Tests for `utils/empirical.py`."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from functools import partial
 from jax import test_util as jtu
 from jax.api import jit
@@ -173,5 +170,33 @@ class EmpiricalTest(jtu.JaxTestCase):
     g_direct = direct(data_other, data_self)
     self.assertAllClose(g, g_direct, check_dtypes=False)
 
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '_train_shape={}_test_shape={}_network={}_{}'.format(
+              train, test, network, out_logits),
+          'train_shape': train,
+          'test_shape': test,
+          'network': network,
+          'out_logits': out_logits
+      } for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
+                          for out_logits in OUTPUT_LOGITS))
+  def testJointAgainstSeparate(
+      self, train_shape, test_shape, network, out_logits):
+    key = random.PRNGKey(0)
+    key, self_split, other_split = random.split(key, 3)
+    data_self = random.normal(self_split, train_shape)
+    data_other = random.normal(other_split, test_shape)
+
+    init_fn, f, _ = _build_network(train_shape[1:], network, out_logits)
+    _, params = init_fn(key, (-1,) + train_shape[1:])
+    joint_fn = jit(empirical.empirical_kernel_joint_fn(f))
+    nngp_fn = jit(empirical.empirical_nngp_fn(f))
+    ntk_fn = jit(empirical.empirical_implicit_ntk_fn(f))
+
+    for x1, x2 in ((data_self, None), (data_other, data_self)):
+      nngp, ntk = joint_fn(x1, x2, params)
+      self.assertAllClose(nngp, nngp_fn(x1, x2, params), check_dtypes=False)
+      self.assertAllClose(ntk, ntk_fn(x1, x2, params), check_dtypes=False)
+
 if __name__ == '__main__':
   jtu.absltest.main()
@@ -1,10 +1,6 @@
 # Copyright 2019 The Neural Tangents Authors.  All rights reserved.
 """Tests for `utils/monte_carlo.py`."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-
 from jax import test_util as jtu
 from jax.config import config as jax_config
 from jax.lib import xla_bridge
@@ -70,7 +66,7 @@ class MonteCarloTest(jtu.JaxTestCase):
                           for get in ALL_GET))
   def test_sample_once_batch(self, batch_size, device_count, store_on_device,
                              get):
-    utils.stub_out_pmap(batch, device_count)
+    utils.skip_unless_device_count(self, device_count)
 
     x1, x2, init_fn, apply_fn, _, key = _get_inputs_and_model()
     kernel_fn = empirical.empirical_kernel_fn(apply_fn)
@@ -100,7 +96,7 @@ class MonteCarloTest(jtu.JaxTestCase):
                           for get in ALL_GET))
   def test_batch_sample_once(self, batch_size, device_count, store_on_device,
                              get):
-    utils.stub_out_pmap(batch, device_count)
+    utils.skip_unless_device_count(self, device_count)
 
     x1, x2, init_fn, apply_fn, _, key = _get_inputs_and_model()
     kernel_fn = empirical.empirical_kernel_fn(apply_fn)
@@ -126,7 +122,7 @@ class MonteCarloTest(jtu.JaxTestCase):
                           for store_on_device in STORE_ON_DEVICE))
   def test_sample_vs_analytic_nngp(self, batch_size, device_count,
                                    store_on_device):
-    utils.stub_out_pmap(batch, device_count)
+    utils.skip_unless_device_count(self, device_count)
 
     x1, x2, init_fn, apply_fn, stax_kernel_fn, key = _get_inputs_and_model(
         1024, 256, xla_bridge.get_backend().platform == 'tpu')
@@ -154,7 +150,7 @@ class MonteCarloTest(jtu.JaxTestCase):
                           for store_on_device in STORE_ON_DEVICE))
   def test_monte_carlo_vs_analytic_ntk(self, batch_size, device_count,
                                        store_on_device):
-    utils.stub_out_pmap(batch, device_count)
+    utils.skip_unless_device_count(self, device_count)
 
     x1, x2, init_fn, apply_fn, stax_kernel_fn, key = _get_inputs_and_model(
         256, 2, xla_bridge.get_backend().platform == 'tpu')
@@ -171,6 +167,69 @@ class MonteCarloTest(jtu.JaxTestCase):
 
     utils.assert_close_matrices(self, ker_analytic, ker_empirical, 2e-2)
 
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[n_samples={}, '
+                           'device_count={} '
+                           'store_on_device={} '
+                           ']'.format(n_samples, device_count, store_on_device),
+          'n_samples': n_samples,
+          'device_count': device_count,
+          'store_on_device': store_on_device,
+      } for n_samples in [1, 2, 5, [1, 4, 5]] for device_count in [0, 2]
+                          for store_on_device in STORE_ON_DEVICE))
+  def test_monte_carlo_vmap_block_size(self, n_samples, device_count,
+                                       store_on_device):
+    utils.skip_unless_device_count(self, device_count)
+
+    x1, x2, init_fn, apply_fn, _, key = _get_inputs_and_model(8, 1)
+
+    sample_fn = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, key, n_samples, 2, device_count, store_on_device,
+        vmap_block_size=1)
+    sample_fn_blocks = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, key, n_samples, 2, device_count, store_on_device,
+        vmap_block_size=3)
+
+    samples = sample_fn(x1, x2, ('nngp', 'ntk'))
+    samples_blocks = sample_fn_blocks(x1, x2, ('nngp', 'ntk'))
+    if isinstance(n_samples, int):
+      samples, samples_blocks = [samples], [samples_blocks]
+
+    count = 0
+    for sample, sample_blocks in zip(samples, samples_blocks):
+      self.assertAllClose(sample, sample_blocks, True)
+      count += 1
+    self.assertEqual(1 if isinstance(n_samples, int) else len(n_samples),
+                     count)
+
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name': '[store_on_device={}]'.format(store_on_device),
+          'store_on_device': store_on_device,
+      } for store_on_device in STORE_ON_DEVICE))
+  def test_monte_carlo_dtype(self, store_on_device):
+    # XLA's CPU backend does not reliably support float16, so on CPU float64
+    # samples are returned as float32 instead.
+    if xla_bridge.get_backend().platform == 'cpu':
+      if not jax_config.read('jax_enable_x64'):
+        raise jtu.SkipTest('Requires float64 samples on CPU.')
+      dtype = np.float32
+    else:
+      dtype = np.float16
+
+    x1, x2, init_fn, apply_fn, _, key = _get_inputs_and_model(8, 1)
+
+    sample_fn = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, key, 4, 2, 0, store_on_device)
+    sample_fn_cast = monte_carlo.monte_carlo_kernel_fn(
+        init_fn, apply_fn, key, 4, 2, 0, store_on_device, dtype=dtype)
+
+    ker = sample_fn(x1, x2, 'ntk')
+    ker_cast = sample_fn_cast(x1, x2, 'ntk')
+    self.assertEqual(dtype, ker_cast.dtype)
+    utils.assert_close_matrices(self, ker, ker_cast.astype(ker.dtype), 1e-2)
+
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
           'testcase_name': '[batch_size={}, '
@@ -188,7 +247,7 @@ class MonteCarloTest(jtu.JaxTestCase):
                           for get in ALL_GET))
   def test_monte_carlo_generator(self, batch_size, device_count,
                                  store_on_device, get):
-    utils.stub_out_pmap(batch, device_count)
+    utils.skip_unless_device_count(self, device_count)
 
     x1, x2, init_fn, apply_fn, stax_kernel_fn, key = _get_inputs_and_model(8, 1)
     x3, x4, _, _, _, _ = _get_inputs_and_model(8, 1)
@@ -252,4 +311,5 @@ class MonteCarloTest(jtu.JaxTestCase):
 
 
 if __name__ == '__main__':
+  utils.set_host_device_count(2)
   jtu.absltest.main()
@@ -1,11 +1,11 @@
 # Copyright 2019 The Neural Tangents Authors.  All rights reserved.
 """Tests for `utils/predict.py`."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
+from functools import lru_cache
+from functools import partial
 import math
 
+from jax import lax
 from jax import test_util as jtu
 from jax.api import device_get
 from jax.api import grad
@@ -47,7 +47,12 @@ OUTPUT_LOGITS = [1, 2, 3]
 
 CONVOLUTION_CHANNELS = 256
 
+# Number of Monte Carlo samples drawn in parallel per platform. Bounds peak
+# memory to that many empirical kernels at a time.
+MC_BATCH_SIZE = {'cpu': 10, 'gpu': 50, 'tpu': 50}
 
+
+@lru_cache(maxsize=None)
 def _build_network(input_shape, network, out_logits):
   if len(input_shape) == 1:
     assert network == 'FLAT'
@@ -69,18 +74,33 @@ def _build_network(input_shape, network, out_logits):
     raise ValueError('Expected flat or image test input.')
 
 
+# NOTE: the dynamics tests draw fresh parameters per case but share networks, so
+# the jitted kernel functions are memoized per `(input_shape, network,
+# out_logits)` and take `params` as an argument; `get` is static.
+@lru_cache(maxsize=None)
+def _jit_empirical_kernel_fn(input_shape, network, out_logits):
+  _, f, _ = _build_network(input_shape, network, out_logits)
+  return jit(empirical.empirical_kernel_fn(f), static_argnums=(3,))
+
+
 def _empirical_kernel(key, input_shape, network, out_logits):
   init_fn, f, _ = _build_network(input_shape, network, out_logits)
   _, params = init_fn(key, (-1,) + input_shape)
-  _kernel_fn = empirical.empirical_kernel_fn(f)
+  _kernel_fn = _jit_empirical_kernel_fn(input_shape, network, out_logits)
   kernel_fn = lambda x1, x2, get: _kernel_fn(x1, x2, params, get)
-  return params, f, jit(kernel_fn, static_argnums=(2,))
+  return params, f, kernel_fn
+
+
+@lru_cache(maxsize=None)
+def _jit_theoretical_kernel_fn(input_shape, network, out_logits):
+  _, _, kernel_fn = _build_network(input_shape, network, out_logits)
+  return jit(kernel_fn, static_argnums=(2,))
 
 
 def _theoretical_kernel(key, input_shape, network, out_logits):
-  init_fn, f, kernel_fn = _build_network(input_shape, network, out_logits)
+  init_fn, f, _ = _build_network(input_shape, network, out_logits)
   _, params = init_fn(key, (-1,) + input_shape)
-  return params, f, jit(kernel_fn, static_argnums=(2,))
+  return params, f, _jit_theoretical_kernel_fn(input_shape, network, out_logits)
 
 
 KERNELS = {
@@ -89,6 +109,18 @@ KERNELS = {
 }
 
 
+@lru_cache(maxsize=None)
+def _get_inputs(out_logits, test_shape, train_shape, f=None):
+  x_key, y_key, test_key, key = random.split(random.PRNGKey(0), 4)
+  x_train = random.normal(x_key, train_shape)
+  y_train = random.bernoulli(
+      y_key, shape=(train_shape[0], out_logits)).astype(np.float32)
+  x_test = random.normal(test_key, test_shape)
+  if f is not None:
+    x_train, x_test = f(x_train), f(x_test)
+  return key, x_train, x_test, y_train
+
+
 @optimizers.optimizer
 def momentum(learning_rate, momentum=0.9):
   """A standard momentum optimizer for testing.
@@ -101,6 +133,7 @@ def momentum(learning_rate, momentum=0.9):
     v0 = np.zeros_like(x0)
     return x0, v0
 
+  @jit
   def update_fn(i, g, state):
     x, velocity = state
     velocity = momentum * velocity + g
@@ -114,6 +147,51 @@ def momentum(learning_rate, momentum=0.9):
   return init_fn, update_fn, get_params
 
 
+def _min_eigvalsh(mat):
+  """Smallest eigenvalue of a symmetric matrix, on device where supported."""
+  # JAX does not support `eigh` on TPU, so it is computed on the host there.
+  if xla_bridge.get_backend().platform == 'tpu':
+    return np.onp.min(np.onp.linalg.eigvalsh(mat))
+  return np.min(np.linalg.eigvalsh(mat))
+
+
+@partial(jit, static_argnums=(0,))
+def _eval_all(f, params, params_final, x_train, x_test):
+  """Outputs of `f` on train and test data for initial and final `params`."""
+  return (f(params, x_train), f(params, x_test),
+          f(params_final, x_train), f(params_final, x_test))
+
+
+@jit
+def _errors(fx_train, fx_test, fx_initial_train, fx_initial_test,
+            fx_pred_train, fx_pred_test):
+  """Prediction errors normalized by the displacement from initialization."""
+  fx_disp_train = np.sqrt(np.mean((fx_train - fx_initial_train)**2))
+  fx_disp_test = np.sqrt(np.mean((fx_test - fx_initial_test)**2))
+  return ((fx_train - fx_pred_train) / fx_disp_train,
+          (fx_test - fx_pred_test) / fx_disp_test)
+
+
+def _train(opt_update, get_params, grad_loss, opt_state, x_train, steps,
+           unroll=4):
+  """Run `steps` optimizer updates as a single compiled loop.
+
+  `steps` must be a Python integer. The loop body applies `unroll` consecutive
+  updates, and the remaining `steps % unroll` updates run in a second loop.
+  """
+  def step_fn(i, opt_state):
+    return opt_update(i, grad_loss(get_params(opt_state), x_train), opt_state)
+
+  def body_fn(i, opt_state):
+    for j in range(unroll):
+      opt_state = step_fn(i * unroll + j, opt_state)
+    return opt_state
+
+  n_unrolled = steps // unroll
+  opt_state = lax.fori_loop(0, n_unrolled, body_fn, opt_state)
+  return lax.fori_loop(n_unrolled * unroll, steps, step_fn, opt_state)
+
+
 class PredictTest(jtu.JaxTestCase):
 
   @jtu.parameterized.named_parameters(
@@ -137,18 +215,16 @@ class PredictTest(jtu.JaxTestCase):
   def testMaxLearningRate(self, train_shape, network, out_logits, fn_and_kernel,
                           name):
 
-    key = random.PRNGKey(0)
+    x_key, y_key, key = random.split(random.PRNGKey(0), 3)
 
-    key, split = random.split(key)
     if len(train_shape) == 2:
       train_shape = (train_shape[0] * 5, train_shape[1] * 10)
     else:
       train_shape = (16, 8, 8, 3)
-    x_train = random.normal(split, train_shape)
+    x_train = random.normal(x_key, train_shape)
 
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
+    y_train = random.bernoulli(
+        y_key, shape=(train_shape[0], out_logits)).astype(np.float32)
 
     for lr_factor in [0.5, 3.]:
       params, f, ntk = fn_and_kernel(key, train_shape[1:], network, out_logits)
@@ -174,9 +250,8 @@ class PredictTest(jtu.JaxTestCase):
 
       init_loss = get_loss(opt_state)
 
-      for i in range(steps):
-        params = get_params(opt_state)
-        opt_state = opt_update(i, grad_loss(params, x_train), opt_state)
+      opt_state = _train(opt_update, get_params, grad_loss, opt_state,
+                         x_train, steps)
 
       trained_loss = get_loss(opt_state)
       loss_ratio = trained_loss / (init_loss + 1e-12)
@@ -207,17 +282,8 @@ class PredictTest(jtu.JaxTestCase):
   def testNTKMSEPrediction(self, train_shape, test_shape, network, out_logits,
                            fn_and_kernel):
 
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = random.normal(split, train_shape)
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = random.normal(split, test_shape)
+    key, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                                train_shape)
 
     params, f, ntk = fn_and_kernel(key, train_shape[1:], network, out_logits)
 
@@ -246,32 +312,18 @@ class PredictTest(jtu.JaxTestCase):
 
     opt_init, opt_update, get_params = optimizers.sgd(step_size)
     opt_state = opt_init(params)
+    opt_state = _train(opt_update, get_params, grad_loss, opt_state, x_train,
+                       steps)
 
-    fx_initial_train = f(params, x_train)
-    fx_initial_test = f(params, x_test)
-
-    fx_pred_train, fx_pred_test = predictor(0.0, fx_initial_train,
-                                            fx_initial_test)
-
-    self.assertAllClose(fx_initial_train, fx_pred_train, True)
-    self.assertAllClose(fx_initial_test, fx_pred_test, True)
-
-    for i in range(steps):
-      params = get_params(opt_state)
-      opt_state = opt_update(i, grad_loss(params, x_train), opt_state)
-
-    params = get_params(opt_state)
-    fx_train = f(params, x_train)
-    fx_test = f(params, x_test)
+    fx_initial_train, fx_initial_test, fx_train, fx_test = _eval_all(
+        f, params, get_params(opt_state), x_train, x_test)
 
     fx_pred_train, fx_pred_test = predictor(train_time, fx_initial_train,
                                             fx_initial_test)
 
-    fx_disp_train = np.sqrt(np.mean((fx_train - fx_initial_train)**2))
-    fx_disp_test = np.sqrt(np.mean((fx_test - fx_initial_test)**2))
-
-    fx_error_train = (fx_train - fx_pred_train) / fx_disp_train
-    fx_error_test = (fx_test - fx_pred_test) / fx_disp_test
+    fx_error_train, fx_error_test = _errors(fx_train, fx_test, fx_initial_train,
+                                            fx_initial_test, fx_pred_train,
+                                            fx_pred_test)
 
     self.assertAllClose(fx_error_train, np.zeros_like(fx_error_train), True,
                         rtol, atol)
@@ -298,17 +350,8 @@ class PredictTest(jtu.JaxTestCase):
                           for name, fn in KERNELS.items()))
   def testNTKGDPrediction(self, train_shape, test_shape, network, out_logits,
                           fn_and_kernel):
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = random.normal(split, train_shape)
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = random.normal(split, test_shape)
+    key, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                                train_shape)
 
     params, f, ntk = fn_and_kernel(key, train_shape[1:], network, out_logits)
 
@@ -336,32 +379,18 @@ class PredictTest(jtu.JaxTestCase):
 
     opt_init, opt_update, get_params = optimizers.sgd(step_size)
     opt_state = opt_init(params)
+    opt_state = _train(opt_update, get_params, grad_loss, opt_state, x_train,
+                       steps)
 
-    fx_initial_train = f(params, x_train)
-    fx_initial_test = f(params, x_test)
-
-    fx_pred_train, fx_pred_test = predictor(0.0, fx_initial_train,
-                                            fx_initial_test)
-
-    self.assertAllClose(fx_initial_train, fx_pred_train, True)
-    self.assertAllClose(fx_initial_test, fx_pred_test, True)
-
-    for i in range(steps):
-      params = get_params(opt_state)
-      opt_state = opt_update(i, grad_loss(params, x_train), opt_state)
-
-    params = get_params(opt_state)
-    fx_train = f(params, x_train)
-    fx_test = f(params, x_test)
+    fx_initial_train, fx_initial_test, fx_train, fx_test = _eval_all(
+        f, params, get_params(opt_state), x_train, x_test)
 
     fx_pred_train, fx_pred_test = predictor(train_time, fx_initial_train,
                                             fx_initial_test)
 
-    fx_disp_train = np.sqrt(np.mean((fx_train - fx_initial_train)**2))
-    fx_disp_test = np.sqrt(np.mean((fx_test - fx_initial_test)**2))
-
-    fx_error_train = (fx_train - fx_pred_train) / fx_disp_train
-    fx_error_test = (fx_test - fx_pred_test) / fx_disp_test
+    fx_error_train, fx_error_test = _errors(fx_train, fx_test, fx_initial_train,
+                                            fx_initial_test, fx_pred_train,
+                                            fx_pred_test)
 
     self.assertAllClose(fx_error_train, np.zeros_like(fx_error_train), True,
                         rtol, atol)
@@ -390,17 +419,8 @@ class PredictTest(jtu.JaxTestCase):
                           if len(train) == 2))
   def testNTKMomentumPrediction(self, train_shape, test_shape, network,
                                 out_logits, fn_and_kernel):
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = random.normal(split, train_shape)
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = random.normal(split, test_shape)
+    key, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                                train_shape)
 
     params, f, ntk = fn_and_kernel(key, train_shape[1:], network, out_logits)
 
@@ -429,38 +449,67 @@ class PredictTest(jtu.JaxTestCase):
 
     opt_init, opt_update, get_params = momentum(step_size, 0.9)
     opt_state = opt_init(params)
+    opt_state = _train(opt_update, get_params, grad_loss, opt_state, x_train,
+                       steps)
 
-    fx_initial_train = f(params, x_train)
-    fx_initial_test = f(params, x_test)
+    fx_initial_train, fx_initial_test, fx_train, fx_test = _eval_all(
+        f, params, get_params(opt_state), x_train, x_test)
 
     lin_state = init(fx_initial_train, fx_initial_test)
-    fx_pred_train, fx_pred_test = get(lin_state)
-
-    self.assertAllClose(fx_initial_train, fx_pred_train, True)
-    self.assertAllClose(fx_initial_test, fx_pred_test, True)
-
-    for i in range(steps):
-      params = get_params(opt_state)
-      opt_state = opt_update(i, grad_loss(params, x_train), opt_state)
-
-    params = get_params(opt_state)
-    fx_train = f(params, x_train)
-    fx_test = f(params, x_test)
 
     lin_state = predictor(lin_state, train_time)
     fx_pred_train, fx_pred_test = get(lin_state)
 
-    fx_disp_train = np.sqrt(np.mean((fx_train - fx_initial_train)**2))
-    fx_disp_test = np.sqrt(np.mean((fx_test - fx_initial_test)**2))
-
-    fx_error_train = (fx_train - fx_pred_train) / fx_disp_train
-    fx_error_test = (fx_test - fx_pred_test) / fx_disp_test
+    fx_error_train, fx_error_test = _errors(fx_train, fx_test, fx_initial_train,
+                                            fx_initial_test, fx_pred_train,
+                                            fx_pred_test)
 
     self.assertAllClose(fx_error_train, np.zeros_like(fx_error_train), True,
                         rtol, atol)
     self.assertAllClose(fx_error_test, np.zeros_like(fx_error_test), True, rtol,
                         atol)
 
+  @jtu.parameterized.named_parameters(
+      jtu.cases_from_list({
+          'testcase_name':
+              '_train={}_test={}_network={}_logits={}_{}'.format(
+                  train, test, network, out_logits, name),
+          'train_shape':
+              train,
+          'test_shape':
+              test,
+          'network':
+              network,
+          'out_logits':
+              out_logits,
+          'fn_and_kernel':
+              fn
+      } for train, test, network in zip(TRAIN_SHAPES, TEST_SHAPES, NETWORK)
+                          for out_logits in OUTPUT_LOGITS
+                          for name, fn in KERNELS.items()))
+  def testNTKZeroTimePrediction(self, train_shape, test_shape, network,
+                                out_logits, fn_and_kernel):
+    """Test that the dynamics predictions match the network outputs at t=0."""
+    key, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                                train_shape)
+
+    params, f, ntk = fn_and_kernel(key, train_shape[1:], network, out_logits)
+
+    loss = lambda y, y_hat: 0.5 * np.mean((y - y_hat)**2)
+
+    g_dd = ntk(x_train, None, 'ntk')
+    g_td = ntk(x_test, x_train, 'ntk')
+
+    fx_initial = (f(params, x_train), f(params, x_test))
+
+    mse_predictor = predict.gradient_descent_mse(g_dd, y_train, g_td)
+    gd_predictor = predict.gradient_descent(g_dd, y_train, loss, g_td)
+    init, _, get = predict.momentum(g_dd, y_train, loss, 0.5, g_td)
+
+    self.assertAllClose(fx_initial, mse_predictor(0.0, *fx_initial), True)
+    self.assertAllClose(fx_initial, gd_predictor(0.0, *fx_initial), True)
+    self.assertAllClose(fx_initial, get(init(*fx_initial)), True)
+
   @jtu.parameterized.named_parameters(
       jtu.cases_from_list({
           'testcase_name':
@@ -481,17 +530,8 @@ class PredictTest(jtu.JaxTestCase):
   def testNTKMeanCovPrediction(self, train_shape, test_shape, network,
                                out_logits):
 
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
+    _, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                              train_shape, np.cos)
     _, _, kernel_fn = _build_network(train_shape[1:], network, out_logits)
     mean_pred, cov_pred = predict.gp_inference(
         kernel_fn,
@@ -502,24 +542,15 @@ class PredictTest(jtu.JaxTestCase):
         diag_reg=0.,
         compute_cov=True)
 
-    if xla_bridge.get_backend().platform == 'tpu':
-      eigh = np.onp.linalg.eigh
-    else:
-      eigh = np.linalg.eigh
-
     self.assertEqual(cov_pred.shape[0], x_test.shape[0])
-    min_eigh = np.min(eigh(cov_pred)[0])
-    self.assertGreater(min_eigh + 1e-10, 0.)
+    self.assertGreater(_min_eigvalsh(cov_pred) + 1e-10, 0.)
 
     def mc_sampling(count=10):
-      key = random.PRNGKey(100)
       init_fn, f, _ = _build_network(train_shape[1:], network, out_logits)
-      _kernel_fn = empirical.empirical_kernel_fn(f)
-      kernel_fn = jit(lambda x1, x2, params: _kernel_fn(x1, x2, params, 'ntk'))
-      collect_test_predict = []
-      for _ in range(count):
-        key, split = random.split(key)
-        _, params = init_fn(split, train_shape)
+      kernel_fn = jit(empirical.empirical_ntk_fn(f))
+
+      def sample_test_predict(key):
+        _, params = init_fn(key, train_shape)
 
         g_dd = kernel_fn(x_train, None, params)
         g_td = kernel_fn(x_test, x_train, params)
@@ -529,8 +560,17 @@ class PredictTest(jtu.JaxTestCase):
         fx_initial_test = f(params, x_test)
 
         _, fx_pred_test = predictor(1.0e8, fx_initial_train, fx_initial_test)
-        collect_test_predict.append(fx_pred_test)
-      collect_test_predict = np.array(collect_test_predict)
+        return fx_pred_test
+
+      # Draw samples in parallel batches instead of one network at a time.
+      batch_size = min(
+          MC_BATCH_SIZE.get(xla_bridge.get_backend().platform, 1), count)
+      assert count % batch_size == 0, (count, batch_size)
+      keys = random.split(random.PRNGKey(100), count)
+      keys = np.reshape(keys, (count // batch_size, batch_size, -1))
+      collect_test_predict = lax.map(vmap(sample_test_predict), keys)
+      collect_test_predict = np.reshape(
+          collect_test_predict, (count,) + collect_test_predict.shape[2:])
       mean_emp = np.mean(collect_test_predict, axis=0)
       mean_subtracted = collect_test_predict - mean_emp
       cov_emp = np.einsum(
@@ -564,18 +604,10 @@ class PredictTest(jtu.JaxTestCase):
                           for out_logits in OUTPUT_LOGITS))
   def testGPInferenceGet(self, train_shape, test_shape, network, out_logits):
 
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
-    _, _, kernel_fn = _build_network(train_shape[1:], network, out_logits)
+    _, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                              train_shape, np.cos)
+    # All calls below share one compiled kernel per requested `get`.
+    kernel_fn = _jit_theoretical_kernel_fn(train_shape[1:], network, out_logits)
 
     out = predict.gp_inference(
         kernel_fn,
@@ -648,17 +680,8 @@ class PredictTest(jtu.JaxTestCase):
   def testInfiniteTimeAgreement(self, train_shape, test_shape, network,
                                 out_logits, get):
 
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
+    _, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                              train_shape, np.cos)
     _, _, kernel_fn = _build_network(train_shape[1:], network, out_logits)
 
     reg = 1e-7
@@ -699,17 +722,8 @@ class PredictTest(jtu.JaxTestCase):
   def testZeroTimeAgreement(self, train_shape, test_shape, network, out_logits):
     """Test that the NTK and NNGP agree at t=0."""
 
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
+    _, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                              train_shape, np.cos)
     _, _, ker_fun = _build_network(train_shape[1:], network, out_logits)
 
     reg = 1e-7
@@ -748,17 +762,8 @@ class PredictTest(jtu.JaxTestCase):
                           for out_logits in OUTPUT_LOGITS))
   def testNTK_NTKNNGPAgreement(self, train_shape, test_shape, network,
                                out_logits):
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
+    _, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                              train_shape, np.cos)
     _, _, ker_fun = _build_network(train_shape[1:], network, out_logits)
 
     reg = 1e-7
@@ -850,17 +855,8 @@ class PredictTest(jtu.JaxTestCase):
                               TRAIN_SHAPES[:-1], TEST_SHAPES[:-1], NETWORK[:-1])
                           for out_logits in OUTPUT_LOGITS))
   def testNTKPredCovPosDef(self, train_shape, test_shape, network, out_logits):
-    key = random.PRNGKey(0)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
-
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
-
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
+    _, x_train, x_test, y_train = _get_inputs(out_logits, test_shape,
+                                              train_shape, np.cos)
     _, _, ker_fun = _build_network(train_shape[1:], network, out_logits)
 
     reg = 1e-7
@@ -877,15 +873,10 @@ class PredictTest(jtu.JaxTestCase):
 
     ntk_cov_predictions = [ntk_predictions(t).covariance for t in ts]
 
-    if xla_bridge.get_backend().platform == 'tpu':
-      eigh = np.onp.linalg.eigh
-    else:
-      eigh = np.linalg.eigh
-
     check_symmetric = np.array(
         [np.max(np.abs(cov - cov.T)) for cov in ntk_cov_predictions])
     check_pos_evals = np.min(
-        np.array([eigh(cov)[0] + 1e-10 for cov in ntk_cov_predictions]))
+        np.array([_min_eigvalsh(cov) + 1e-10 for cov in ntk_cov_predictions]))
 
     self.assertAllClose(check_symmetric, np.zeros_like(check_symmetric), True)
     self.assertGreater(check_pos_evals, 0., True)
@@ -923,18 +914,13 @@ class PredictTest(jtu.JaxTestCase):
     opt_init, opt_update, get_params = optimizers.sgd(learning_rate)
     opt_update = jit(opt_update)
 
-    key = random.PRNGKey(0)
-    key, = random.split(key, 1)
-
-    key, split = random.split(key)
-    x_train = np.cos(random.normal(split, train_shape))
+    x_key, y_key, test_key, key = random.split(random.PRNGKey(0), 4)
 
-    key, split = random.split(key)
-    y_train = np.array(
-        random.bernoulli(split, shape=(train_shape[0], out_logits)), np.float32)
+    x_train = np.cos(random.normal(x_key, train_shape))
+    y_train = random.bernoulli(
+        y_key, shape=(train_shape[0], out_logits)).astype(np.float32)
     train = (x_train, y_train)
-    key, split = random.split(key)
-    x_test = np.cos(random.normal(split, test_shape))
+    x_test = np.cos(random.normal(test_key, test_shape))
 
     ensemble_key = random.split(key, ensemble_size)
 
@@ -2,9 +2,6 @@
 
 """Tests for stax.py."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from functools import partial
 from jax import test_util as jtu
 from jax.config import config as jax_config
@@ -2,9 +2,6 @@
 
 """Tests for `examples/weight_space.py`."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from jax import test_util as jtu
 from jax.config import config
 from examples import weight_space
@@ -2,14 +2,12 @@
 
 """Batch kernel calculations serially or in parallel."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from functools import partial
 
 from jax.api import device_get
 from jax.api import jit
 from jax.api import pmap
+from jax.api import vmap
 from jax.lib import xla_bridge
 import jax.numpy as np
 from jax.tree_util import tree_all
@@ -18,10 +16,11 @@ from jax.tree_util import tree_multimap
 from .kernel import Kernel
 
 
-def _scan(f, init, xs, store_on_device):
+def _scan(f, init, xs, store_on_device, move_to_cpu=False):
   """Implements an unrolled version of scan.
 
-  Based on `jax.lax.scan` and has an identical API.
+  Based on `jax.lax.scan` and has an identical API. If `move_to_cpu` is
+  `True`, every `y` output by `f` is brought back to the CPU.
 
   TODO: We introduce this function because lax.scan currently has a
   higher peak memory usage than the unrolled version. We will aim to swap this
@@ -32,9 +31,20 @@ def _scan(f, init, xs, store_on_device):
 
   carry = init
   ys = []
+  pending = None
   for x in xs:
     carry, y = f(carry, x)
-    ys += [y]
+    if move_to_cpu:
+      # Copy the previous output only once the current one is dispatched, so
+      # that the transfer overlaps with the asynchronous computation.
+      if pending is not None:
+        ys += [_move_kernel_to_cpu(pending)]
+      pending = y
+    else:
+      ys += [y]
+
+  if pending is not None:
+    ys += [_move_kernel_to_cpu(pending)]
 
   return carry, tree_multimap(lambda *y: stack(y), *ys)
 
@@ -61,46 +71,71 @@ def _flatten_batch_dimensions(k, discard_axis=None):
                        k.shape[2] * k.shape[3]) + k.shape[4:])
 
 
+def _flatten_arrays(arrays, discard_axes):
+  return tuple(_flatten_batch_dimensions(k, discard_axis)
+               for k, discard_axis in zip(arrays, discard_axes))
+
+
+# NOTE: all array fields of a kernel are flattened in a single call, so that
+# flattening takes one dispatch regardless of the number of fields.
+_flatten_arrays_jit = jit(_flatten_arrays, static_argnums=(1,))
+_flatten_arrays_cpu = jit(_flatten_arrays, static_argnums=(1,), backend='cpu')
+
+
+def _check_batched_shape(value):
+  if any([x.ndim > 2 for x in value]):
+    raise ValueError((
+        'After batching, shape arrays expected to be either'
+        ' one- or two-dimensional.'))
+
+
+def _flatten_shape1(value):
+  _check_batched_shape(value)
+  return tuple(int(x[(0,) * x.ndim]) if i > 0 else
+               int(np.sum(x[:, 0])) if x.ndim == 2 else
+               int(np.sum(x)) for i, x in enumerate(value))
+
+
+def _flatten_shape2(value):
+  _check_batched_shape(value)
+  return tuple(int(x[(0,) * x.ndim]) if i > 0 else
+               int(np.sum(x[0])) if x.ndim == 2 else
+               int(x[0]) for i, x in enumerate(value))
+
+
+# NOTE: Currently we have to make the boolean and integer fields concrete so
+# that batched analytic kernels compose.
+_FLATTEN_CONCRETE_FIELD = {
+    'is_height_width': lambda value: bool(value[(0,) * value.ndim]),
+    'is_gaussian': lambda value: bool(value[(0,) * value.ndim]),
+    'marginal': lambda value: int(value[(0,) * value.ndim]),
+    'cross': lambda value: int(value[(0,) * value.ndim]),
+    'shape1': _flatten_shape1,
+    'shape2': _flatten_shape2,
+}
+
+# Batch axes along which array fields are constant and only one slice is kept.
+_FLATTEN_DISCARD_AXIS = {'var1': 1, 'var2': 0}
+
+
 def _flatten_kernel(k, x2_is_none, store_on_device):
   """Flattens a kernel array or a `Kernel` along the batch dimension."""
-  fl = (_flatten_batch_dimensions if store_on_device else
-        jit(_flatten_batch_dimensions, static_argnums=(1,), backend='cpu'))
   if hasattr(k, '_asdict'):
-    k_dict = k._asdict()
-    k = k._replace(**dict((key, 0.) for key in k_dict))
-    for key, value in k_dict.items():
-      if key == 'var1':
-        k_dict[key] = fl(value, 1)
-      elif key == 'var2':
-        if x2_is_none:
-          k_dict[key] = None
-        else:
-          k_dict[key] = fl(value, 0)
-      elif key in ('is_height_width', 'is_gaussian'):
-        # NOTE: Currently we have to make these values concrete so that
-        # batched analytic kernels compose.
-        k_dict[key] = bool(value[(0,) * value.ndim])
-      elif key in ('marginal', 'cross'):
-        k_dict[key] = int(value[(0,) * value.ndim])
-      elif key == 'shape1':
-        if any([x.ndim > 2 for x in value]):
-          raise ValueError((
-              'After batching, shape arrays expected to be either'
-              ' one- or two-dimensional.'))
-        k_dict[key] = tuple(int(x[(0,) * x.ndim]) if i > 0 else
-                            int(np.sum(x[:, 0])) if x.ndim == 2 else
-                            int(np.sum(x)) for i, x in enumerate(value))
-      elif key == 'shape2':
-        if any([x.ndim > 2 for x in value]):
-          raise ValueError((
-              'After batching, shape arrays expected to be either'
-              ' one- or two-dimensional.'))
-        k_dict[key] = tuple(int(x[(0,) * x.ndim]) if i > 0 else
-                            int(np.sum(x[0])) if x.ndim == 2 else
-                            int(x[0]) for i, x in enumerate(value))
+    flat = {}
+    array_keys = []
+    for key, value in zip(k._fields, k):
+      if key in _FLATTEN_CONCRETE_FIELD:
+        flat[key] = _FLATTEN_CONCRETE_FIELD[key](value)
+      elif key == 'var2' and x2_is_none:
+        flat[key] = None
       else:
-        k_dict[key] = fl(value, None)
-    return k._replace(**k_dict)
+        array_keys.append(key)
+
+    fl = _flatten_arrays_jit if store_on_device else _flatten_arrays_cpu
+    arrays = fl(tuple(getattr(k, key) for key in array_keys),
+                tuple(_FLATTEN_DISCARD_AXIS.get(key) for key in array_keys))
+    flat.update(zip(array_keys, arrays))
+    return type(k)(*[flat[key] for key in k._fields])
 
   if isinstance(k, np.ndarray):
     return _flatten_batch_dimensions(k)
@@ -138,7 +173,54 @@ def _slice_kernel(kernel, n1_slice, n2_slice):
       shape2=(var2.shape[0],) + kernel.shape2[1:])
 
 
-def _serial(kernel_fn, batch_size, store_on_device=True):
+def _trim_arrays(arrays, sizes):
+  """Keeps the first `sizes[i]` entries along the leading axes of `arrays[i]`."""
+  return tuple(x[tuple(slice(None, n) for n in size)]
+               for x, size in zip(arrays, sizes))
+
+
+# NOTE: like flattening, trimming takes a single call, and kernels stored on
+# the CPU are trimmed there rather than copied back to the default device.
+_trim_arrays_jit = jit(_trim_arrays, static_argnums=(1,))
+_trim_arrays_cpu = jit(_trim_arrays, static_argnums=(1,), backend='cpu')
+
+
+def _trim_kernel(kernel, n1, n2, store_on_device):
+  """Keeps the first `n1` rows and `n2` columns of a kernel."""
+  trim = _trim_arrays_jit if store_on_device else _trim_arrays_cpu
+
+  if isinstance(kernel, Kernel):
+    sizes = {'var1': (n1,), 'var2': (n2,), 'nngp': (n1, n2), 'ntk': (n1, n2)}
+  elif hasattr(kernel, '_asdict'):
+    sizes = dict((k, (n1, n2)) for k in kernel._fields)
+  else:
+    return trim((kernel,), ((n1, n2),))[0]
+
+  keys = [k for k in sizes if getattr(kernel, k) is not None]
+  arrays = trim(tuple(getattr(kernel, k) for k in keys),
+                tuple(sizes[k] for k in keys))
+  kernel = kernel._replace(**dict(zip(keys, arrays)))
+  if isinstance(kernel, Kernel):
+    kernel = kernel._replace(shape1=(n1,) + kernel.shape1[1:],
+                             shape2=(n2,) + kernel.shape2[1:])
+  return kernel
+
+
+def _pad_to_multiple(x, multiple):
+  """Pads `x` along the first axis to a multiple of `multiple` examples.
+
+  Padding repeats the last example rather than using zeros, so that the kernel
+  of padded entries stays finite (e.g. for kernels normalizing by the input
+  norm).
+  """
+  ragged = x.shape[0] % multiple
+  if not ragged:
+    return x
+  padding = np.broadcast_to(x[-1:], (multiple - ragged,) + x.shape[1:])
+  return np.concatenate((x, padding))
+
+
+def _serial(kernel_fn, batch_size, store_on_device=True, vmap_blocks=False):
   """Returns a function that computes a kernel in batches serially.
 
   This function computes the kernel over data in batches where each batch is
@@ -147,9 +229,11 @@ def _serial(kernel_fn, batch_size, store_on_device=True):
   distributed over multiple devices) then serial adjusts the batch size so that
   each device processes chunks of work that have batch_size x batch_size.
 
-  The dataset size must divide the effective batch size. If parallelism is used
-  this means that |x1| must divide batch_size * device_count and |x2| must
-  divide batch_size.
+  If the dataset size does not divide the effective batch size, the inputs are
+  padded to a whole number of batches and the padded entries are dropped from
+  the result. If parallelism is used the effective batch size is
+  batch_size * device_count for x1 and batch_size for x2. Input kernels are not
+  padded, so for them the dataset size must divide the effective batch size.
 
   Args:
     kernel_fn: A function that computes a kernel between two datasets,
@@ -162,6 +246,10 @@ def _serial(kernel_fn, batch_size, store_on_device=True):
     store_on_device: A boolean that species whether the computed kernel should
         be kept on device or brought back to CPU as it is computed. Defaults to
         True.
+    vmap_blocks: A boolean that specifies whether to compute all batches at
+        once with `vmap` when the kernel is computed and stored on a single
+        device. This is faster for small kernels, but holds the intermediate
+        values of all batches in memory at once. Defaults to False.
 
   Returns:
     A new function with the same signature as kernel_fn that computes the kernel
@@ -172,13 +260,14 @@ def _serial(kernel_fn, batch_size, store_on_device=True):
   if is_parallel:
     device_count = kernel_fn.device_count
 
-  if not store_on_device:
-    _kernel_fn = kernel_fn
-    def kernel_fn(x1, x2=None, *args, **kwargs):
-      return _move_kernel_to_cpu(_kernel_fn(x1, x2, *args, **kwargs))
-
   flatten = partial(_flatten_kernel, store_on_device=store_on_device)
 
+  def vmap_all_blocks(x1s, x2s, *args, **kwargs):
+    block_fn = lambda x1, x2: kernel_fn(x1, x2, *args, **kwargs)
+    return vmap(vmap(block_fn, (None, 0)), (0, None))(x1s, x2s)
+
+  vmap_blocks_jit = _jit_or_pmap_broadcast(vmap_all_blocks, device_count=0)
+
   def serial_fn_x1(x1, x2=None, *args, **kwargs):
     x2_is_none = x2 is None
     if x2_is_none:
@@ -190,34 +279,37 @@ def _serial(kernel_fn, batch_size, store_on_device=True):
     input_shape = x1.shape[1:]
 
     n1_batch_size = batch_size if not is_parallel else batch_size * device_count
-    n1_batches, ragged = divmod(n1, n1_batch_size)
-    if ragged:
-      # TODO: Relax this constraint.
-      msg = ('Number of examples in x1 must divide batch size. Found |x1| = {} '
-             'and batch size = {}.').format(n1, n1_batch_size)
-      if is_parallel:
-        msg += (' Note that device parallelism was detected and so the batch '
-                'size was expanded by a factor of {}.'.format(device_count))
-      raise ValueError(msg)
 
-    n2_batches, ragged = divmod(n2, batch_size)
-    if ragged:
-      # TODO: Relax this constraint.
-      raise ValueError((
-          'Number of examples in x2 must divide batch size. Found |x2| = {} '
-          'and batch size = {}').format(n2, batch_size))
+    # Pad ragged inputs so that all batches have the same shape and the kernel
+    # is only compiled once.
+    x1 = _pad_to_multiple(x1, n1_batch_size)
+    x2 = _pad_to_multiple(x2, batch_size)
+    n1_batches = x1.shape[0] // n1_batch_size
+    n2_batches = x2.shape[0] // batch_size
 
     x1s = np.reshape(x1, (n1_batches, n1_batch_size,) + input_shape)
     x2s = np.reshape(x2, (n2_batches, batch_size,) + input_shape)
 
-    def row_fn(_, x1):
-      return _, _scan(col_fn, x1, x2s, store_on_device)[1]
+    def trim_and_flatten(kernel):
+      kernel = flatten(kernel, x2_is_none)
+      if x1.shape[0] != n1 or x2.shape[0] != n2:
+        kernel = _trim_kernel(kernel, n1, n2, store_on_device)
+      return kernel
+
+    if vmap_blocks and store_on_device and not is_parallel:
+      return trim_and_flatten(vmap_blocks_jit(x1s, x2s, *args, **kwargs))
+
+    col_scan = partial(_scan, store_on_device=store_on_device,
+                       move_to_cpu=not store_on_device)
 
     def col_fn(x1, x2):
       return x1, kernel_fn(x1, x2, *args, **kwargs)
 
+    def row_fn(_, x1):
+      return _, col_scan(col_fn, x1, x2s)[1]
+
     _, kernel = _scan(row_fn, 0, x1s, store_on_device)
-    return flatten(kernel, x2_is_none)
+    return trim_and_flatten(kernel)
 
   def serial_fn_kernel(kernel, *args, **kwargs):
     n1 = kernel.var1.shape[0]
@@ -245,7 +337,8 @@ def _serial(kernel_fn, batch_size, store_on_device=True):
     n2s = np.arange(0, n2, batch_size)
 
     def row_fn(_, n1):
-      return _, _scan(col_fn, n1, n2s, store_on_device)[1]
+      return _, _scan(col_fn, n1, n2s, store_on_device,
+                      move_to_cpu=not store_on_device)[1]
 
     def col_fn(n1, n2):
       # NOTE: If we end up wanting to enable jit-of-batch then we will
@@ -377,7 +470,8 @@ def _parallel(kernel_fn, device_count=-1):
   return parallel_fn
 
 
-def batch(kernel_fn, batch_size=0, device_count=-1, store_on_device=True):
+def batch(kernel_fn, batch_size=0, device_count=-1, store_on_device=True,
+          vmap_blocks=False):
   """Returns a function that computes a kernel in batches over all devices.
 
   Args:
@@ -388,40 +482,43 @@ def batch(kernel_fn, batch_size=0, device_count=-1, store_on_device=True):
     batch_size: Integer specifying the size of each batch that gets processed
         per physical device. Because we parallelize the computation over columns
         it should be the case that |x1| is divisible by
-        device_count * batch_size and |x2| is divisible by batch_size.
+        device_count * batch_size and |x2| is divisible by batch_size. Inputs
+        that are not are padded to a whole number of batches.
     device_count: Integer specifying the number of physical devices to be mapped
         over. If device_count = -1 all devices are used. If device_count = 0,
         no device parallelism is used.
     store_on_device: A boolean that species whether the computed kernel should
         be kept on device or brought back to CPU as it is computed. Defaults to
         True.
+    vmap_blocks: A boolean that specifies whether to compute all batches at
+        once with `vmap` when no device parallelism is used and the kernel is
+        stored on device. This is faster for small kernels, but holds the
+        intermediate values of all batches in memory at once. Defaults to False.
 
   Returns:
     A new function with the same signature as kernel_fn that computes the kernel
     by batching over the dataset in parallel with the specified batch_size.
   """
   if (device_count == -1 and xla_bridge.device_count() > 1) or device_count > 0:
-    kernel_fn = _parallel(kernel_fn, device_count)
+    batched_fn = _parallel(kernel_fn, device_count)
   else:
-    kernel_fn = _jit_or_pmap_broadcast(kernel_fn, device_count=0)
+    batched_fn = _jit_or_pmap_broadcast(kernel_fn, device_count=0)
 
-  if not batch_size:
-    return kernel_fn
+  if batch_size:
+    batched_fn = _serial(batched_fn, batch_size, store_on_device, vmap_blocks)
 
-  return _serial(kernel_fn, batch_size, store_on_device)
+  return batched_fn
 
 
 def _is_np_ndarray(x):
+  # Short-circuit the common leaf arguments before walking a PyTree.
+  if isinstance(x, np.ndarray):
+    return True
+  if x is None or isinstance(x, (bool, int, float, str)):
+    return False
   return tree_all(tree_map(lambda y: isinstance(y, np.ndarray), x))
 
 
-def _merge_dicts(a, b):
-  # TODO: Replace by {**a, **b} when Python 2 is depricated.
-  merged = dict(a)
-  merged.update(b)
-  return merged
-
-
 def _get_jit_or_pmap_broadcast():
   """Initializes a cache of pmapped functions closed over non-`np.ndarray` args.
 
@@ -464,7 +561,14 @@ def _get_jit_or_pmap_broadcast():
     def broadcast(arg):
       if device_count == 0:
         return arg
-      return np.broadcast_to(arg, (device_count,) + arg.shape)
+      shape = (device_count,) + arg.shape
+      if isinstance(arg, np.onp.ndarray):
+        # A zero-stride view of a host array: `pmap` slices it and sends each
+        # device one copy, so the copies are never materialized.
+        return np.onp.broadcast_to(arg, shape)
+      # Arrays already on a device are broadcast there, rather than copied back
+      # to the host.
+      return np.broadcast_to(arg, shape)
 
     def f_pmapped(x_or_kernel, *args, **kwargs):
       args_np, args_np_idxs = [], []
@@ -494,24 +598,32 @@ def _get_jit_or_pmap_broadcast():
         else:
           args_other[i] = arg
 
-      # Check cache before jitting.
-      _key = key + \
-          tuple(args_other.items()) + \
-          tuple(kwargs.items()) + \
-          tuple(x_or_kernel_other.items())
+      # Check cache before jitting. In the common case of array-only inputs
+      # the key does not depend on the call and is not rebuilt.
+      if args_other or kwargs or x_or_kernel_other:
+        _key = key + \
+            tuple(args_other.items()) + \
+            tuple(kwargs.items()) + \
+            tuple(x_or_kernel_other.items())
+      else:
+        _key = key
       if _key in cache:
         _f = cache[_key]
       else:
+        # For each positional argument, its index in `_args_np`, or `None` if
+        # it is closed over.
+        np_idxs = {i: j for j, i in enumerate(args_np_idxs)}
+        arg_slots = tuple(np_idxs.get(i) for i in range(len(args)))
+
         # Define a `np.ndarray`-only function as a closure over other arguments.
         def _f(_x_or_kernel_np, *_args_np):
           # Merge Kernel.
           if is_input_kernel:
-            _x_or_kernel_np = _merge_dicts(_x_or_kernel_np, x_or_kernel_other)
+            _x_or_kernel_np = {**_x_or_kernel_np, **x_or_kernel_other}
             _x_or_kernel_np = Kernel(**_x_or_kernel_np)
           # Merge args.
-          _args_np = {i: _arg_np for i, _arg_np in zip(args_np_idxs, _args_np)}
-          _args = _merge_dicts(_args_np, args_other)
-          _args = tuple(v for k, v in sorted(_args.items()))
+          _args = tuple(args_other[i] if j is None else _args_np[j]
+                        for i, j in enumerate(arg_slots))
           return f(_x_or_kernel_np, *_args, **kwargs)
 
         _f = jit(_f) if device_count == 0 else pmap(_f)
@@ -2,20 +2,24 @@
 
 """Compute the empirical NTK and approximate functions via Taylor series."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
-import operator
 from collections import namedtuple
+from functools import lru_cache
 from absl import flags
+from jax import lax
 from jax.api import eval_shape
 from jax.api import jacobian
+from jax.api import jit
 from jax.api import jvp
+from jax.api import linearize as jax_linearize
+from jax.api import ShapeDtypeStruct
 from jax.api import vjp
+from jax.api import vmap
 from jax.config import config
 import jax.numpy as np
+from jax.tree_util import tree_flatten
+from jax.tree_util import tree_leaves
 from jax.tree_util import tree_multimap
-from jax.tree_util import tree_reduce
+from jax.tree_util import tree_unflatten
 from neural_tangents.utils import flags as internal_flags
 from neural_tangents.utils.utils import get_namedtuple
 
@@ -53,6 +57,14 @@ def linearize(f, params):
   return f_lin
 
 
+def _append_jvp(derivatives, dparams):
+  """Extend a tuple of directional derivatives of `f` by one more order."""
+  def derivatives_next(p):
+    vals, val_jvps = jvp(derivatives, (p,), (dparams,))
+    return vals + (val_jvps[-1],)
+  return derivatives_next
+
+
 def taylor_expand(f, params, degree):
   """Returns a function f_tayl, the Taylor approximation to f of degree degree.
 
@@ -75,21 +87,20 @@ def taylor_expand(f, params, degree):
     Here f_tayl implements the degree-order taylor series of f about params.
   """
 
-  def taylorize_r(f, params, dparams, degree, current_degree):
-    """Recursive function to accumulate contributions to the Taylor series."""
-    if current_degree == degree:
-      return f(params)
-
-    def f_jvp(p):
-      _, val_jvp = jvp(f, (p,), (dparams,))
-      return val_jvp
-
-    df = taylorize_r(f_jvp, params, dparams, degree, current_degree+1)
-    return f(params) + df / (current_degree + 1)
-
   def f_tayl(p, x):
     dparams = tree_multimap(lambda x, y: x - y, p, params)
-    return taylorize_r(lambda param: f(param, x), params, dparams, degree, 0)
+
+    # Build the derivatives of all orders along `dparams` as the outputs of a
+    # single nested `jvp`, so that each order is evaluated only once.
+    derivatives = lambda param: (f(param, x),)
+    for _ in range(degree):
+      derivatives = _append_jvp(derivatives, dparams)
+    derivatives = derivatives(params)
+
+    f_tayl_x = derivatives[-1]
+    for k in reversed(range(degree)):
+      f_tayl_x = derivatives[k] + f_tayl_x / (k + 1)
+    return f_tayl_x
 
   return f_tayl
 
@@ -101,16 +112,59 @@ def flatten_features(kernel):
   """Flatten an empirical kernel."""
   if kernel.ndim == 2:
     return kernel
+  return _flatten_features(kernel)
+
+
+@jit
+def _flatten_features(kernel):
+  # NOTE: jitted so that the transposition and reshape are fused into a single
+  # dispatch without materializing the transposed kernel. Shapes are static
+  # under `jit`, so one variant is compiled per kernel shape.
   assert kernel.ndim % 2 == 0
   half_shape = (kernel.ndim - 1) // 2
   n1, n2 = kernel.shape[:2]
   feature_size = int(np.prod(kernel.shape[2 + half_shape:]))
-  transposition = ((0,) + tuple(i + 2 for i in range(half_shape)) +
-                   (1,) + tuple(i + 2 + half_shape for i in range(half_shape)))
-  kernel = np.transpose(kernel, transposition)
+  kernel = np.transpose(kernel, _flatten_transposition(kernel.ndim))
   return np.reshape(kernel, (feature_size *  n1, feature_size * n2))
 
 
+def _flatten_transposition(ndim):
+  half_shape = (ndim - 1) // 2
+  return ((0,) + tuple(i + 2 for i in range(half_shape)) +
+          (1,) + tuple(i + 2 + half_shape for i in range(half_shape)))
+
+
+def _implicit_ntk_ordering(ndim):
+  return ((0, ndim) + tuple(range(1, ndim)) +
+          tuple(x + ndim for x in range(1, ndim)))
+
+
+def _transpose_implicit_ntk(ntk, ndim):
+  """Reorder the Jacobian of the implicit NTK to `[n1, n2] + ...`."""
+  return np.transpose(ntk, _implicit_ntk_ordering(ndim))
+
+
+def _vjp_jvp_on_basis(fx1_jvp, fx2_vjp, fx2):
+  """Materializes `fx1_jvp(*fx2_vjp(delta))` for all standard basis `delta`s.
+
+  Since the map is linear in `delta` it is `vmap`ped over the basis of the
+  output space of `fx2` directly, rather than differentiated with `jacobian`.
+  Returns an array of shape `fx1.shape + fx2.shape`.
+  """
+  size = int(np.prod(fx2.shape))
+  basis = np.reshape(np.eye(size, dtype=fx2.dtype), (size,) + fx2.shape)
+  ntk = vmap(lambda delta: fx1_jvp(*fx2_vjp(delta)))(basis)
+  ntk = np.moveaxis(ntk, 0, -1)
+  return np.reshape(ntk, ntk.shape[:-1] + fx2.shape)
+
+
+def _nngp(out1, out2):
+  """Empirical NNGP from network outputs, treating the last axis as samples."""
+  contracting_dims = ((out1.ndim - 1,), (out2.ndim - 1,))
+  nngp_12 = lax.dot_general(out1, out2, (contracting_dims, ((), ())))
+  return nngp_12 / out1.shape[-1]
+
+
 def empirical_implicit_ntk_fn(f):
   """Computes the ntk without batching for inputs x1 and x2.
 
@@ -121,10 +175,10 @@ def empirical_implicit_ntk_fn(f):
   substantially more efficient (especially as the number of parameters grows)
   to compute the NTK implicitly.
 
-  This involves using JAX's autograd to compute derivatives of linear functions
-  (which do not depend on the inputs). Thus, we find it more efficient to refer
-  to fx_dummy for the outputs of the network. fx_dummy has the same shape as
-  the output of the network on a single piece of input data.
+  This involves composing the VJP of the network on `x2` with its JVP on `x1`,
+  which is a linear function of the output cotangents, and evaluating it on
+  every standard basis vector of the output space of `f(params, x2)` with a
+  single `vmap`.
 
   TODO: Write up a better description of the implicit method.
 
@@ -153,24 +207,15 @@ def empirical_implicit_ntk_fn(f):
     """
     if x2 is None:
       x2 = x1
-    fx2_struct = eval_shape(f, params, x2)
-    fx_dummy = np.ones(fx2_struct.shape, fx2_struct.dtype)
-
-    def delta_vjp_jvp(delta):
-      def delta_vjp(delta):
-        return vjp(lambda p: f(p, x2), params)[1](delta)
-      return jvp(lambda p: f(p, x1), (params,), delta_vjp(delta))[1]
-
-    ntk = jacobian(delta_vjp_jvp)(fx_dummy)
-    ndim = len(fx2_struct.shape)
-    ordering = (0, ndim) + tuple(range(1, ndim)) + \
-        tuple(x + ndim for x in range(1, ndim))
-    return np.transpose(ntk, ordering)
+    fx2, fx2_vjp = vjp(lambda p: f(p, x2), params)
+    fx1_jvp = lambda *dparams: jvp(lambda p: f(p, x1), (params,), dparams)[1]
+    ntk = _vjp_jvp_on_basis(fx1_jvp, fx2_vjp, fx2)
+    return _transpose_implicit_ntk(ntk, fx2.ndim)
 
   return ntk_fn
 
 
-def empirical_direct_ntk_fn(f):
+def empirical_direct_ntk_fn(f, precision=None):
   """Computes the ntk without batching for inputs x1 and x2.
 
   The Neural Tangent Kernel is defined as J(X_1)^T J(X_2) where J is the
@@ -180,20 +225,29 @@ def empirical_direct_ntk_fn(f):
     f: The function whose NTK we are computing. f should have the signature
        f(params, inputs) and should return an `np.ndarray` of outputs with shape
        [|inputs|, output_dim].
+    precision: precision of the Jacobian contraction, either `None` for the
+      backend default or a `jax.lax.Precision` value. Lower precision can be
+      substantially faster on accelerators with reduced-precision matrix units.
 
   Returns:
     A function `ntk_fn` that computes the empirical ntk.
   """
-  jac_fn = jacobian(f)
+  # NOTE: both are jitted once per `f`, so that every call (e.g. every batch in
+  # `batch.batch`) reuses the compiled Jacobian and a single fused contraction.
+  jac_fn = jit(jacobian(f))
 
+  @jit
   def sum_and_contract(j1, j2):
-    def contract(x, y):
-      param_count = int(np.prod(x.shape[2:]))
-      x = np.reshape(x, x.shape[:2] + (param_count,))
-      y = np.reshape(y, y.shape[:2] + (param_count,))
-      return np.dot(x, np.transpose(y, (0, 2, 1)))
+    def contract(x1, x2):
+      x1 = np.reshape(x1, x1.shape[:2] + (-1,))
+      x2 = np.reshape(x2, x2.shape[:2] + (-1,))
+      return lax.dot_general(x1, x2, (((2,), (2,)), ((), ())), precision)
 
-    return tree_reduce(operator.add, tree_multimap(contract, j1, j2))
+    # Contract each parameter array separately and sum the results inside the
+    # `jit`, so that the Jacobians are never copied into one concatenated
+    # buffer.
+    return sum(contract(x1, x2)
+               for x1, x2 in zip(tree_leaves(j1), tree_leaves(j2)))
 
   def ntk_fn(x1, x2, params):
     """Computes the empirical ntk.
@@ -223,9 +277,72 @@ def empirical_direct_ntk_fn(f):
   return ntk_fn
 
 
-empirical_ntk_fn = (empirical_implicit_ntk_fn
-                     if FLAGS.tangents_optimized else
-                     empirical_direct_ntk_fn)
+# The implicit NTK is used when the number of parameters exceeds this multiple
+# of `n * output_size**2`, above which the Jacobians of the direct method
+# dominate both memory and compute.
+_IMPLICIT_NTK_PARAMS_RATIO = 4
+
+
+# Number of distinct input feature and parameter shapes per function for which
+# the sizes deciding between the implicit and direct NTK are remembered.
+_NTK_METHOD_CACHE_SIZE = 32
+
+
+def _use_implicit_ntk_fn(f):
+  """Returns a function deciding whether to use the implicit NTK of `f`.
+
+  The implicit method is used when the number of parameters exceeds
+  `_IMPLICIT_NTK_PARAMS_RATIO * n * output_size**2`, and never if
+  `--tangents_optimized=False`.
+  """
+  @lru_cache(maxsize=_NTK_METHOD_CACHE_SIZE)
+  def sizes(x_spec, params_treedef, param_specs):
+    params = tree_unflatten(params_treedef,
+                            [ShapeDtypeStruct(*spec) for spec in param_specs])
+    fx = eval_shape(f, params, ShapeDtypeStruct(*x_spec))
+    param_count = sum(int(np.prod(shape)) for shape, _ in param_specs)
+    return param_count, int(np.prod(fx.shape[1:]))
+
+  def use_implicit(x1, x2, params):
+    if not FLAGS.tangents_optimized:
+      return False
+
+    leaves, params_treedef = tree_flatten(params)
+    param_count, output_size = sizes(
+        ((1,) + x1.shape[1:], x1.dtype), params_treedef,
+        tuple((leaf.shape, leaf.dtype) for leaf in leaves))
+    n = x1.shape[0] + (0 if x2 is None else x2.shape[0])
+    return param_count > _IMPLICIT_NTK_PARAMS_RATIO * n * output_size**2
+
+  return use_implicit
+
+
+def empirical_ntk_fn(f):
+  """Returns a function computing the empirical NTK of `f`.
+
+  The implicit (`empirical_implicit_ntk_fn`) or direct
+  (`empirical_direct_ntk_fn`) method is chosen on each call from the number of
+  parameters, inputs and outputs. Setting `--tangents_optimized=False` always
+  selects the direct method.
+
+  Args:
+    f: The function whose NTK we are computing. f should have the signature
+       f(params, inputs) and should return an `np.ndarray` of outputs with shape
+       [|inputs|, output_dim].
+
+  Returns:
+    A function `ntk_fn(x1, x2, params)` that computes the empirical ntk.
+  """
+  implicit_ntk_fn = empirical_implicit_ntk_fn(f)
+  direct_ntk_fn = empirical_direct_ntk_fn(f)
+  use_implicit = _use_implicit_ntk_fn(f)
+
+  def ntk_fn(x1, x2, params):
+    if use_implicit(x1, x2, params):
+      return implicit_ntk_fn(x1, x2, params)
+    return direct_ntk_fn(x1, x2, params)
+
+  return ntk_fn
 
 
 def empirical_nngp_fn(f):
@@ -248,6 +365,15 @@ def empirical_nngp_fn(f):
   Returns:
      A function to draw a single sample the NNGP of a given network `f`.
   """
+  @jit
+  def nngp_diag(x1, params):
+    out1 = f(params, x1)
+    return _nngp(out1, out1)
+
+  @jit
+  def nngp_off_diag(x1, x2, params):
+    return _nngp(f(params, x1), f(params, x2))
+
   def nngp_fn(x1, x2, params):
     """Sample a single NNGP of a given network `f` on given inputs and `params`.
 
@@ -271,16 +397,39 @@ def empirical_nngp_fn(f):
       A Monte Carlo estimate of the NNGP, a `np.ndarray` of shape
       `[batch_size_1] + output_shape[:-1] + [batch_size_2] + output_shape[:-1]`.
     """
-    out1 = f(params, x1)
-    out2 = f(params, x2) if x2 is not None else out1
-
-    out2 = np.expand_dims(out2, -1)
-    nngp_12 = np.dot(out1, out2) / out1.shape[-1]
-    return np.squeeze(nngp_12, -1)
+    if x2 is None:
+      return nngp_diag(x1, params)
+    return nngp_off_diag(x1, x2, params)
 
   return nngp_fn
 
 
+def empirical_kernel_joint_fn(f):
+  """Returns a function computing single draws of both the NNGP and the NTK.
+
+  Equivalent to `empirical_nngp_fn` and `empirical_implicit_ntk_fn`, except that
+  the network outputs `f(params, x1)` and `f(params, x2)` are each computed once
+  and shared by both kernels.
+
+  Args:
+    f: a function computing the output of the neural network.
+
+  Returns:
+    A function `kernel_fn(x1, x2, params)` returning a tuple `(nngp, ntk)`.
+  """
+  def kernel_fn(x1, x2, params):
+    if x2 is None:
+      x2 = x1
+    fx1, fx1_jvp = jax_linearize(lambda p: f(p, x1), params)
+    fx2, fx2_vjp = vjp(lambda p: f(p, x2), params)
+
+    nngp = _nngp(fx1, fx2)
+    ntk = _vjp_jvp_on_basis(fx1_jvp, fx2_vjp, fx2)
+    return nngp, _transpose_implicit_ntk(ntk, fx2.ndim)
+
+  return kernel_fn
+
+
 def empirical_kernel_fn(f):
   """Returns a function that computes single draws from NNGP and NT kernels."""
 
@@ -288,6 +437,8 @@ def empirical_kernel_fn(f):
       'nngp': empirical_nngp_fn(f),
       'ntk': empirical_ntk_fn(f)
   }
+  joint_fn = empirical_kernel_joint_fn(f)
+  use_implicit = _use_implicit_ntk_fn(f)
 
   @get_namedtuple('EmpiricalKernel')
   def kernel_fn(x1, x2, params, get=None):
@@ -308,6 +459,10 @@ def empirical_kernel_fn(f):
     """
     if get is None:
       get = ('nngp', 'ntk')
+    # The joint function shares the forward passes with the implicit NTK only.
+    if set(get) == {'nngp', 'ntk'} and use_implicit(x1, x2, params):
+      nngp, ntk = joint_fn(x1, x2, params)
+      return {'nngp': nngp, 'ntk': ntk}
     return {g: kernel_fns[g](x1, x2, params) for g in get}
 
   return kernel_fn
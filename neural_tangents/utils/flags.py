@@ -2,9 +2,6 @@
 
 """Describes flags used by neural tangents."""
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
 from absl import flags
 
 
@@ -6,12 +6,16 @@ The library has a public method `monte_carlo_kernel_fn` that allow to compute
   Monte Carlo estimates of NNGP and NTK kernels of arbitrary functions.
 """
 
-from __future__ import absolute_import
-from __future__ import division
-from __future__ import print_function
+from jax import lax
 from jax import random
 from functools import partial
 import operator
+from jax.api import eval_shape
+from jax.api import jit
+from jax.api import vmap
+from jax.lib import xla_bridge
+import jax.numpy as np
+from jax.tree_util import tree_leaves
 from jax.tree_util import tree_map
 from jax.tree_util import tree_multimap
 from neural_tangents.utils import batch
@@ -33,37 +37,176 @@ def _sample_once_kernel_fn(kernel_fn,
   return kernel_fn_sample_once
 
 
+@partial(jit, static_argnums=(1,))
+def _sample_keys(key, n):
+  """Returns `n` keys for independent samples, computed in a single call.
+
+  The `i`-th key does not depend on `n`, so that estimates using the first `n`
+  samples agree across different total numbers of samples.
+  """
+  return vmap(lambda i: random.fold_in(key, i))(np.arange(n))
+
+
+@partial(jit, static_argnums=(2,))
+def _normalize(sample, n, dtype=None):
+  """Divides all leaves of `sample` by `n`, in one call for any `n`.
+
+  Floating point leaves are then cast to `dtype`, if given. Sums are kept in
+  the sample precision, so only the returned estimate is rounded.
+  """
+  def normalize(sample):
+    sample = sample / n
+    if dtype is not None and np.issubdtype(sample.dtype, np.floating):
+      sample = sample.astype(dtype)
+    return sample
+  return tree_map(normalize, sample)
+
+
+def _copy_to_host_async(sample):
+  """Starts copying all leaves of `sample` to the host, without blocking.
+
+  Reading a leaf later (e.g. with `onp.asarray`) waits for its copy only.
+  """
+  for leaf in tree_leaves(sample):
+    if hasattr(leaf, 'copy_to_host_async'):
+      leaf.copy_to_host_async()
+  return sample
+
+
+def _sum_samples(kernel_fn_sample_once, vmap_block_size, keys, start, stop,
+                 x1, x2, get):
+  """Sums samples drawn with `keys[start:stop]` in a single compiled loop.
+
+  Samples are drawn `vmap_block_size` at a time with `vmap`. The last block is
+  masked, so that `start` and `stop` may be traced.
+  """
+  sample_block = vmap(lambda key: kernel_fn_sample_once(x1, x2, key, get))
+
+  ker_sampled = eval_shape(
+      lambda key: kernel_fn_sample_once(x1, x2, key, get), keys[0])
+  ker_sampled = tree_map(lambda x: np.zeros(x.shape, x.dtype), ker_sampled)
+
+  # Pad so that slicing a whole block never runs past the end of `keys`.
+  keys = np.concatenate(
+      [keys, np.zeros((vmap_block_size,) + keys.shape[1:], keys.dtype)])
+
+  def body_fn(i, ker_sampled):
+    block_start = start + i * vmap_block_size
+    block_keys = lax.dynamic_slice_in_dim(keys, block_start, vmap_block_size)
+    is_sample = block_start + np.arange(vmap_block_size) < stop
+
+    def block_sum(x):
+      mask = np.reshape(is_sample, (-1,) + (1,) * (x.ndim - 1))
+      return np.sum(np.where(mask, x, np.zeros_like(x)), 0)
+
+    samples = tree_map(block_sum, sample_block(block_keys))
+    return tree_multimap(operator.add, ker_sampled, samples)
+
+  n_blocks = (stop - start + vmap_block_size - 1) // vmap_block_size
+  return lax.fori_loop(0, n_blocks, body_fn, ker_sampled)
+
+
+_sum_samples_jit = jit(_sum_samples, static_argnums=(0, 1, 7))
+
+
+def _sum_samples_on_device(kernel_fn_sample_once, vmap_block_size,
+                           keys_and_bounds, x1, x2, get):
+  keys, bounds = keys_and_bounds
+  return _sum_samples(kernel_fn_sample_once, vmap_block_size, keys,
+                      bounds[0], bounds[1], x1, x2, get)
+
+
 def _sample_many_kernel_fn(kernel_fn_sample_once, key, n_samples,
-                           get_generator):
-  def normalize(sample, n):
-    return tree_map(lambda sample: sample / n, sample)
+                           get_generator, compile_loop=False,
+                           sample_device_count=0, vmap_block_size=1,
+                           dtype=None, store_on_device=True):
+  # Estimates are copied to the host while later samples are being computed.
+  finalize = (lambda sample: sample) if store_on_device else _copy_to_host_async
+
+  def add(ker_sampled, one_sum):
+    if ker_sampled is None:
+      return one_sum
+    return tree_multimap(operator.add, ker_sampled, one_sum)
+
+  if sample_device_count:
+    sum_samples_parallel = batch._jit_or_pmap_broadcast(
+        partial(_sum_samples_on_device, kernel_fn_sample_once, vmap_block_size),
+        sample_device_count)
+
+  def get_samples_parallel(x1, x2, get):
+    """Yields the running sums at `n_samples`, splitting samples over devices.
+
+    Keys are dealt to devices round-robin, and each device sums the samples of
+    its keys that fall into the current range.
+    """
+    d = sample_device_count
+    keys = _sample_keys(key, n_samples[-1])
+    n_keys = -(-keys.shape[0] // d) * d
+    keys = np.concatenate(
+        [keys, np.zeros((n_keys - keys.shape[0],) + keys.shape[1:],
+                        keys.dtype)])
+    keys = np.swapaxes(np.reshape(keys, (-1, d) + keys.shape[1:]), 0, 1)
+
+    # Number of keys on device `j` among the first `n`.
+    local_count = lambda n: [max(0, -(-(n - j) // d)) for j in range(d)]
+
+    ker_sampled, n_prev = None, 0
+    for n in n_samples:
+      bounds = np.array(list(zip(local_count(n_prev), local_count(n))))
+      device_sums = sum_samples_parallel((keys, bounds), x1, x2, get)
+      ker_sampled = add(ker_sampled,
+                        tree_map(lambda x: np.sum(x, 0), device_sums))
+      n_prev = n
+      yield n, ker_sampled
+
+  def get_samples_compiled(x1, x2, get):
+    """Yields the running sums at `n_samples`."""
+    keys = _sample_keys(key, n_samples[-1])
+    ker_sampled, n_prev = None, 0
+    for n in n_samples:
+      one_sum = _sum_samples_jit(kernel_fn_sample_once, vmap_block_size, keys,
+                                 n_prev, n, x1, x2, get)
+      ker_sampled = add(ker_sampled, one_sum)
+      n_prev = n
+      yield n, ker_sampled
 
   def get_samples(x1, x2, get):
-    if x2 is not None:
-      assert x1.shape[1:] == x2.shape[1:]
+    if sample_device_count:
+      for n, ker_sampled in get_samples_parallel(x1, x2, get):
+        yield n, ker_sampled
+      return
+
+    if compile_loop:
+      for n, ker_sampled in get_samples_compiled(x1, x2, get):
+        yield n, ker_sampled
+      return
 
-    _key = key
-    for n in range(1, max(n_samples) + 1):
-      _key, split = random.split(_key)
-      one_sample = kernel_fn_sample_once(x1, x2, split, get)
+    keys = _sample_keys(key, n_samples[-1])
+    checkpoints = iter(n_samples)
+    checkpoint = next(checkpoints)
+    for n in range(1, n_samples[-1] + 1):
+      one_sample = kernel_fn_sample_once(x1, x2, keys[n - 1], get)
       if n == 1:
         ker_sampled = one_sample
       else:
         ker_sampled = tree_multimap(operator.add, ker_sampled, one_sample)
-      yield n, ker_sampled
+      if n == checkpoint:
+        yield n, ker_sampled
+        checkpoint = next(checkpoints, None)
 
   if get_generator:
     @get_namedtuple('MonteCarloKernel')
     def get_sampled_kernel(x1, x2, get=None):
+      _check_shapes(x1, x2)
       for n, sample in get_samples(x1, x2, get):
-        if n in n_samples:
-          yield normalize(sample, n)
+        yield finalize(_normalize(sample, n, dtype))
   else:
     @get_namedtuple('MonteCarloKernel')
     def get_sampled_kernel(x1, x2, get=None):
+      _check_shapes(x1, x2)
       for n, sample in get_samples(x1, x2, get):
         pass
-      return normalize(sample, n)
+      return finalize(_normalize(sample, n, dtype))
 
   return get_sampled_kernel
 
@@ -74,7 +217,9 @@ def monte_carlo_kernel_fn(init_fn,
                           n_samples,
                           batch_size=0,
                           device_count=-1,
-                          store_on_device=True):
+                          store_on_device=True,
+                          vmap_block_size=1,
+                          dtype=None):
   """Return a Monte Carlo sampler of NTK and NNGP kernels of a given function.
 
   Args:
@@ -96,10 +241,21 @@ def monte_carlo_kernel_fn(init_fn,
     device_count: an integer making the kernel be computed in parallel across
       this number of devices (e.g. GPUs or TPU cores). `-1` means use all
       available devices. `0` means compute on a single device sequentially. If
-      not `0`, must divide `x1.shape[0]`.
+      `store_on_device` is `True`, independent samples are computed on
+      different devices. Otherwise each kernel is split across devices, and
+      `device_count` must divide `x1.shape[0]`.
+    vmap_block_size: number of samples drawn at once with `vmap` by each
+      device. Larger values use the accelerator better for small kernels, at
+      the cost of holding this many samples in memory. Has no effect if kernels
+      are split across devices or moved to the CPU.
     store_on_device: a boolean, indicating whether to store the resulting
       kernel on the device (e.g. GPU or TPU), or in the CPU RAM, where larger
       kernels may fit.
+    dtype: floating point type (e.g. `np.float16` on GPU and TPU, or
+      `np.float32` for float64 samples) of the returned estimates.
+      Samples are summed in their own precision and only the estimates are
+      cast, halving their memory with a rounding error well below the Monte
+      Carlo noise. `None` means returning estimates in the sample precision.
 
   Returns:
     If `n_samples` is an integer, returns a function of signature
@@ -143,20 +299,47 @@ def monte_carlo_kernel_fn(init_fn,
   >>>   # `kernel` is a tuple of NNGP and NTK MC estimate using `n` samples.
   ```
   """
-  kernel_fn = empirical.empirical_kernel_fn(apply_fn)
+  # When kernels stay on device, parallelize over independent samples, each
+  # computed on a single device, rather than over batches of each sample.
+  sample_device_count = 0
+  if store_on_device and _is_parallel(device_count):
+    sample_device_count = (xla_bridge.device_count() if device_count == -1
+                           else device_count)
+    device_count = 0
 
-  kernel_fn_sample_once = _sample_once_kernel_fn(kernel_fn,
-                                                 init_fn,
-                                                 batch_size,
-                                                 device_count,
-                                                 store_on_device)
+  kernel_fn = empirical.empirical_kernel_fn(apply_fn)
+  kernel_fn_sample_once = _sample_once_kernel_fn(
+      kernel_fn, init_fn, batch_size, device_count, store_on_device)
 
   n_samples, get_generator = _canonicalize_n_samples(n_samples)
-  kernel_fn = _sample_many_kernel_fn(kernel_fn_sample_once, key, n_samples,
-                                     get_generator)
+  kernel_fn = _sample_many_kernel_fn(
+      kernel_fn_sample_once, key, n_samples, get_generator,
+      _is_traceable(batch_size, device_count, store_on_device),
+      sample_device_count if sample_device_count > 1 else 0,
+      vmap_block_size, dtype, store_on_device)
   return kernel_fn
 
 
+def _is_parallel(device_count):
+  """Whether `batch.batch` with this `device_count` `pmap`s the kernel."""
+  return ((device_count == -1 and xla_bridge.device_count() > 1) or
+          device_count > 0)
+
+
+def _is_traceable(batch_size, device_count, store_on_device):
+  """Whether a kernel batched with these arguments can be called under `jit`.
+
+  This is the case unless it is `pmap`ped over several devices or its batches
+  are moved to the CPU.
+  """
+  return not _is_parallel(device_count) and (store_on_device or not batch_size)
+
+
+def _check_shapes(x1, x2):
+  if x2 is not None:
+    assert x1.shape[1:] == x2.shape[1:]
+
+
 def _canonicalize_n_samples(n_samples):
   get_generator = True
   if isinstance(n_samples, int):
@@ -176,4 +359,4 @@ def _canonicalize_n_samples(n_samples):
   else:
     raise ValueError('`n_samples` must be either an integer of a set of '
                      'integers, got %s.' % type(n_samples))
-  return n_samples, get_generator
+  return tuple(sorted(n_samples)), get_generator
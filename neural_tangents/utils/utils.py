@@ -2,40 +2,65 @@
 """General-purpose internal utilities."""
 
 from jax.api import jit
-from jax.api import vmap
+from jax.lib import version as jaxlib_version
 from jax.lib import xla_bridge
 import jax.numpy as np
 from collections import namedtuple
+from functools import lru_cache
 from functools import wraps
 import inspect
+import os
 import types
-import six
 
 
-def _jit_vmap(f):
-  return jit(vmap(f))
+# First jaxlib release whose XLA accepts `--xla_force_host_platform_device_count`.
+# XLA aborts on unknown flags, so it is never set for older releases.
+_HOST_DEVICE_COUNT_JAXLIB_VERSION = (0, 1, 36)
 
 
-def stub_out_pmap(batch, count):
-  # If we are using GPU or CPU stub out pmap with vmap to simulate multi-core.
-  if count > 0:
+def set_host_device_count(count):
+  """Asks XLA to expose `count` logical devices on the host CPU platform.
 
-    class xla_bridge_stub(object):
+  Must be called before the JAX backend is initialized (i.e. before the first
+  computation is run), since XLA only reads `XLA_FLAGS` once, when the backend
+  is created. Importing JAX is fine.
 
-      def device_count(self):
-        return count
+  Args:
+    count: number of host devices to request.
 
-    platform = xla_bridge.get_backend().platform
-    if platform == 'gpu' or platform == 'cpu':
-      batch.pmap = _jit_vmap
-      batch.xla_bridge = xla_bridge_stub()
+  Returns:
+    `True` if the devices were requested, `False` if the installed jaxlib is
+    too old to support it.
+  """
+  if jaxlib_version < _HOST_DEVICE_COUNT_JAXLIB_VERSION:
+    return False
+  flags = os.environ.get('XLA_FLAGS', '').split()
+  flags = [f for f in flags
+           if not f.startswith('--xla_force_host_platform_device_count')]
+  flags += ['--xla_force_host_platform_device_count={}'.format(count)]
+  os.environ['XLA_FLAGS'] = ' '.join(flags)
+  return True
+
+
+def skip_unless_device_count(self, count):
+  """Skips the running test if fewer than `count` devices are available."""
+  if xla_bridge.device_count() < count:
+    self.skipTest('Test requires {} devices, found {}.'.format(
+        count, xla_bridge.device_count()))
+
+
+@jit
+def _relative_error(expected, actual):
+  # NOTE: fused into one call, so that `actual - expected` and the two norms
+  # never materialize as separate arrays.
+  diff = actual - expected
+  return (np.sqrt(np.sum(diff * diff)) /
+          np.maximum(np.sqrt(np.sum(expected * expected)), 1e-12))
 
 
 def assert_close_matrices(self, expected, actual, rtol):
   self.assertEqual(expected.shape, actual.shape)
-  relative_error = (
-      np.linalg.norm(actual - expected) /
-      np.maximum(np.linalg.norm(expected), 1e-12))
+  relative_error = float(_relative_error(expected, actual))
   if relative_error > rtol or np.isnan(relative_error):
     self.fail(self.failureException(float(relative_error), expected, actual))
   else:
@@ -46,31 +71,32 @@ def canonicalize_get(get):
   if get is None:
     return True, get
 
+  if isinstance(get, (str, tuple)):
+    return _canonicalize_get(get)
+  return _canonicalize_get.__wrapped__(get)
+
+
+@lru_cache(maxsize=None)
+def _canonicalize_get(get):
   if not get:
     # NOTE: It seems slightly nicer to not support the empty-tuple
     # case. Happy to add support later, if there's a use-case.
     raise ValueError('"get" must be non-empty.')
 
   get_is_not_tuple = isinstance(get, str)
-  if get_is_not_tuple:
-    get = (get,)
+  canonicalized = (get,) if get_is_not_tuple else get
 
-  get = tuple(s.lower() for s in get)
-  if len(set(get)) < len(get):
-    raise ValueError('All entries in "get" must be unique. Got {}'.format(get))
-  return get_is_not_tuple, get
+  canonicalized = tuple(s.lower() for s in canonicalized)
+  if len(set(canonicalized)) < len(canonicalized):
+    raise ValueError('All entries in "get" must be unique. Got {}'.format(
+        canonicalized))
 
-
-_KERNEL_NAMED_TUPLE_CACHE = {}
+  return get_is_not_tuple, canonicalized
 
 
+@lru_cache(maxsize=None)
 def named_tuple_factory(name, get):
-  key = (name, get)
-  if key in _KERNEL_NAMED_TUPLE_CACHE:
-    return _KERNEL_NAMED_TUPLE_CACHE[key]
-  else:
-    _KERNEL_NAMED_TUPLE_CACHE[key] = namedtuple(name, get)
-    return named_tuple_factory(name, get)
+  return namedtuple(name, get)
 
 
 def _output_to_dict(output):
@@ -88,12 +114,15 @@ def _output_to_dict(output):
 
 def get_namedtuple(name):
   def getter_decorator(fn):
-    try:
-      argspec = _argspec(fn)
-      get_index = argspec.args.index('get')
-      defaults = argspec.defaults
-    except:
+    parameters = inspect.signature(fn).parameters
+    if 'get' not in parameters:
       raise ValueError('`get_namedtuple` functions must have a `get` argument.')
+    get_index = list(parameters).index('get')
+
+    # Resolve the default `get` once, at decoration time.
+    default = parameters['get'].default
+    default_get = (None if default is inspect.Parameter.empty
+                   else canonicalize_get(default))
 
     @wraps(fn)
     def getter_fn(*args, **kwargs):
@@ -105,13 +134,12 @@ def get_namedtuple(name):
       elif get_index < len(args):
         get_is_not_tuple, get = canonicalize_get(args[get_index])
         canonicalized_args[get_index] = get
-      elif defaults is None:
+      elif default_get is None:
         raise ValueError(
             '`get_namedtuple` function must have a `get` argument provided or'
             'set by default.')
       else:
-        get_is_not_tuple, get = canonicalize_get(defaults[get_index -
-                                                          len(args)])
+        get_is_not_tuple, get = default_get
 
       fn_out = fn(*canonicalized_args, **kwargs)
 
@@ -138,11 +166,3 @@ def get_namedtuple(name):
     return getter_fn
 
   return getter_decorator
-
-
-def _argspec(func):
-  """Python 2 and 3 compatible argspec."""
-  if six.PY3:
-    return inspect.getfullargspec(func)
-  else:
-    return inspect.getargspec(func)